@@ -0,0 +1,242 @@
+"""
+Regrid many domains in one run, e.g. nested and ensemble domains.
+
+    python batch.py nightly/*.domain other.domain
+
+Arguments are domain files or glob patterns. The row blocks of all
+domains are processed by one pool of worker processes. Every worker
+loads the SoilGrids rasters once per raster setting (resolution,
+layers, store) and group of overlapping domains, and one footprint
+covers all domains of the group, so overlapping domains do not read the
+same pixels again. Each domain gets its own output, checkpoint and
+result buffer. Domains with remap, reproject = 'direct' or a quick-look
+interpolation are run one after another as in soil_init. The settings
+backend, cell_cache, report and cprofile are not used for the domains
+on the pool.
+"""
+import glob
+import itertools
+import multiprocessing
+import sys
+import numpy as np
+
+from checkpoint import Checkpoint
+from domain import Domain
+from geo import Geo
+from metrics import metrics
+from output import Output
+from parallel import Parallel, SharedResults, load_pending, worker_state
+from soil_init import run
+from soilgrids import Soilgrids
+
+
+# per domain state of each worker process, filled once in the first task
+batch_state = {}
+
+
+def get_raster_key(domain):
+    # domains with the same key share one Soilgrids object
+    return (domain.sg_res, domain.sg_cache, domain.sg_tiles,
+            tuple(domain.get_layers()), domain.sg_memmap, domain.reproject,
+            domain.landuse, tuple(domain.get_classes()))
+
+
+def get_extent(domains):
+    # reprojected extent of several domains, None for the global product
+    extents = [domain.get_reproject_extent() for domain in domains]
+    if None in extents:
+        return None
+
+    extents = np.array(extents)
+    return (np.min(extents[:, 0]), np.min(extents[:, 1]),
+            np.max(extents[:, 2]), np.max(extents[:, 3]))
+
+
+def get_box(domains):
+    # geographical bounding box of the footprints of several domains
+    boxes = np.array([domain.get_box() for domain in domains])
+
+    return [tuple(np.min(boxes[:, 0], axis=0)),
+            tuple(np.max(boxes[:, 1], axis=0))]
+
+
+def get_groups(domains):
+    # indices of the domains that share one Soilgrids object: the same
+    # raster key and footprints that overlap, directly or through other
+    # domains of the group; distant domains are not read as one box
+    keys = [get_raster_key(domain) for domain in domains]
+    boxes = np.array([domain.get_box() for domain in domains])
+
+    def joined(group, other):
+        (west, south), (east, north) = np.min(boxes[group, 0], axis=0), \
+            np.max(boxes[group, 1], axis=0)
+        (other_west, other_south), (other_east, other_north) = \
+            np.min(boxes[other, 0], axis=0), np.max(boxes[other, 1], axis=0)
+
+        return keys[group[0]] == keys[other[0]] and \
+            west <= other_east and other_west <= east and \
+            south <= other_north and other_south <= north
+
+    groups = [[k] for k in range(len(domains))]
+    while True:
+        pairs = [(a, b) for a, b in
+                 itertools.combinations(range(len(groups)), 2)
+                 if joined(groups[a], groups[b])]
+        if not pairs:
+            return groups
+        a, b = pairs[0]
+        groups[a] = sorted(groups[a] + groups.pop(b))
+
+
+def get_soilgrids(domains, footprint=False, step=None):
+    # step: processing step of the files chosen by the main process
+    domain = domains[0]
+    box = get_box(domains)
+    soilgrids = Soilgrids.from_domain(domain, get_extent(domains), step, box)
+
+    # at 250m only the footprint of the current row block is read, with
+    # memory maps the boxes are read from the shared pages instead
+    if footprint and domain.sg_res != 'fine' and not domain.sg_memmap:
+        soilgrids.read_area(box)
+
+    return soilgrids
+
+
+def init_worker(domains, names, footprint, steps):
+    # the metrics of the main process are copied into forked workers
+    metrics.reset()
+
+    # the rasters are loaded in the first task, see parallel.load_pending
+    batch_state['load'] = (domains, names, footprint, steps)
+
+
+def load_state(domains, names, footprint, steps):
+    # steps: processing step of each group of get_groups
+    for group, step in zip(get_groups(domains), steps):
+        with metrics.timer('init'):
+            soilgrids = get_soilgrids([domains[k] for k in group],
+                                      footprint, step)
+
+        for k in group:
+            batch_state[k] = dict(domain=domains[k], soilgrids=soilgrids,
+                                  geo=Geo(domains[k]), footprint=footprint,
+                                  results=SharedResults(domains[k],
+                                                        names[k]))
+
+
+def get_block(task):
+    # row block j0:j1 of domain k
+    k, j0, j1 = task
+    load_pending(batch_state, load_state)
+    worker_state.update(batch_state[k])
+    block, stats = Parallel().get_block((j0, j1))
+
+    return task, stats
+
+
+class Batch:
+    def __init__(self, domains):
+        self.domains = domains
+        self.parallel = Parallel()
+
+    def processing(self, max_processes, block_rows=8, footprint=True):
+        # the row blocks of all domains on one pool
+        domains = [domain for domain in self.domains
+                   if not domain.remap and domain.reproject != 'direct' and
+                   domain.interpolation == 'box']
+
+        for domain in domains:
+            unused = [name for name, default in [
+                ('backend', 'process'), ('cell_cache', None),
+                ('report', None), ('cprofile', None)]
+                if getattr(domain, name) != default]
+            if unused:
+                print(f'{domain.output}: {", ".join(unused)} not used in '
+                      'batch mode')
+
+        # downloads and conversions once before the workers start, the
+        # workers read the same files
+        with metrics.timer('init'):
+            steps = [get_soilgrids([domains[k] for k in group]).step
+                     for group in get_groups(domains)]
+
+        results = [SharedResults(domain) for domain in domains]
+        outputs = [Output(domain, filename=domain.output)
+                   for domain in domains]
+        checkpoints = [Checkpoint(domain) if domain.checkpoint else None
+                       for domain in domains]
+        normalize = []
+
+        try:
+            tasks = []
+            for k, domain in enumerate(domains):
+                soilgrids = Soilgrids()
+                soilgrids.layers = domain.get_layers()
+                normalize.append(soilgrids)
+
+                outputs[k].open(block_rows)
+                blocks = self.parallel.get_blocks(domain, block_rows)
+                if checkpoints[k] is not None:
+                    blocks = self.parallel.restore_blocks(
+                        blocks, block_rows, results[k], soilgrids,
+                        outputs[k], checkpoints[k])
+                tasks += [(k, j0, j1) for j0, j1 in blocks]
+
+            names = [result.get_names() for result in results]
+            with metrics.timer('processing'), multiprocessing.Pool(
+                    processes=max_processes, initializer=init_worker,
+                    initargs=(domains, names, footprint, steps)) as pool:
+                for (k, j0, j1), stats in pool.imap_unordered(get_block,
+                                                              tasks):
+                    self.parallel.workers[stats['pid']] = stats
+                    self.parallel.finish_block(
+                        j0, j1, results[k], normalize[k], outputs[k],
+                        checkpoints[k])
+
+            for output, checkpoint in zip(outputs, checkpoints):
+                output.close()
+                # the output is complete, the checkpoint is not needed
+                if checkpoint is not None:
+                    checkpoint.remove()
+        finally:
+            for result in results:
+                result.close()
+
+        # the other domains one after another
+        for domain in self.domains:
+            if domain not in domains:
+                run(domain)
+
+
+def main():
+    filenames = []
+    for pattern in sys.argv[1:]:
+        filenames += sorted(glob.glob(pattern)) or [pattern]
+
+    if not filenames:
+        print('ERROR: no domain files')
+        exit()
+
+    domains = []
+    for filename in filenames:
+        domain = Domain()
+        domain.read_domain_file(filename)
+        domain.get_rlons_rlats()
+        domains.append(domain)
+
+    outputs = [domain.output for domain in domains]
+    if len(set(outputs)) != len(outputs):
+        print('ERROR: the domains must have different outputs; exit')
+        exit()
+
+    batch = Batch(domains)
+    batch.processing(max(domain.processes for domain in domains))
+
+    for name, seconds in metrics.timers.items():
+        print(f'{name}: {seconds:.3f} s')
+    print(f'{len(domains)} domains, total: '
+          f'{metrics.get_stats()["elapsed"]:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
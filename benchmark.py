@@ -0,0 +1,445 @@
+"""
+Benchmarks of soil_init on synthetic SoilGrids rasters and domains.
+
+Synthetic EPSG:4326 rasters (5000m, 1000m and 250m tiles) are made for
+the area of the largest domain, so no download is needed. The hot paths
+are timed in this process, the full pipeline in a subprocess per domain
+size and worker count. The timings and the metrics reports of the runs
+are written to one JSON file. With --compare, the outputs are compared
+with those of an earlier benchmark directory. With --download, the
+segmented download is checked against a local server with range
+requests: a complete download, the continuation of an interrupted one
+and the restart after the file on the server has changed. With
+--threads, the thread backend is checked to keep at most prefetch +
+workers row-block footprints in memory.
+
+    python benchmark.py --resolutions coarse medium --sizes 16 32 64 \
+        --workers 1 2 4 --workdir ./benchmark
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from netCDF4 import Dataset
+
+from domain import Domain
+from geo import Geo
+from helper import Helper
+from output import Output
+from parallel import Parallel
+from soilgrids import Soilgrids
+from store import Store
+
+
+# pixel size in degrees of the synthetic rasters
+RESOLUTIONS = {'coarse': 0.05, 'medium': 0.01, 'fine': 0.0025}
+
+# mean of the synthetic fields in g/kg and cm3/dm3
+VARIABLES = dict(sand=400, silt=350, clay=250, cfvo=120)
+
+DOMAIN = """name = '{name}'
+dx = {dx}
+pol_lon = -170.0
+pol_lat = 40.0
+ie_tot = {size}
+je_tot = {size}
+startlat = {start}
+startlon = {start}
+dx_coarse = 0.44
+start_date = '2020-01-01'
+end_date = '2020-01-02'
+sg_res = '{resolution}'
+sg_cache = '{root}'
+sg_tiles = '{root}/fine'
+output = '{output}'
+report = '{report}'
+processes = {processes}
+"""
+
+
+def make_domain(workdir, resolution, size, processes=1, dx=0.11):
+    # rotated-pole domain of size x size grid boxes around rlon = rlat = 0
+    name = f'{resolution}_{size}_{processes}'
+    filename = f'{workdir}/{name}.domain'
+
+    with open(filename, 'w') as file:
+        file.write(DOMAIN.format(
+            name=name, dx=dx, size=size, start=-(size - 1) * dx / 2,
+            resolution=resolution, root=f'{workdir}/soilgrids',
+            output=f'{workdir}/{name}.nc', report=f'{workdir}/{name}.json',
+            processes=processes))
+
+    domain = Domain()
+    domain.read_domain_file(filename)
+    domain.get_rlons_rlats()
+
+    return domain, filename
+
+
+def make_field(var, shape, lon0, lat0, res):
+    # smooth texture with noise and nodata holes like lakes; the value of
+    # a pixel depends only on its position, so rasters of different
+    # extents or tilings agree where they overlap
+    base = VARIABLES[var]
+    k = list(VARIABLES).index(var)
+
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    lon = lon0 + (cols + 0.5) * res
+    lat = lat0 - (rows + 0.5) * res
+
+    # pseudo random noise from the global pixel index
+    i = np.rint(lon / res)
+    j = np.rint(lat / res)
+    noise = (np.sin(i * 12.9898 + j * 78.233 + k) * 43758.5453) % 1
+
+    field = base + 80 * np.sin(lon / 1.8 + k) + 60 * np.cos(lat / 1.2 - k)
+    field += 60 * (noise - 0.5)
+    field[(np.sin(lon * 2.1) * np.cos(lat * 1.7)) > 0.97] = -32768
+
+    return field.astype(np.int16)
+
+
+def write_tiff(filename, data, lon0, lat0, res):
+    Helper().make_dir(os.path.dirname(filename))
+    with rasterio.open(filename, 'w', driver='GTiff',
+                       height=data.shape[0], width=data.shape[1], count=1,
+                       dtype='int16', crs='EPSG:4326',
+                       transform=from_origin(lon0, lat0, res, res),
+                       nodata=-32768, compress='deflate', tiled=True) as dst:
+        dst.write(data, 1)
+
+
+def make_rasters(workdir, resolution, extent, tile=2000):
+    # EPSG:4326 products in the store layout, 250m as tiles of
+    # tile x tile pixels in {store}/fine/{var}/
+    res = RESOLUTIONS[resolution]
+    west, south, east, north = extent
+    width = int(round((east - west) / res))
+    height = int(round((north - south) / res))
+
+    store = Store(f'{workdir}/soilgrids')
+
+    for var in VARIABLES:
+        if resolution != 'fine':
+            filename = store.get_path(var, resolution, 'epsg4326')
+            if not Helper().check_file(filename):
+                data = make_field(var, (height, width), west, north, res)
+                write_tiff(filename, data, west, north, res)
+            continue
+
+        for row in range(0, height, tile):
+            for col in range(0, width, tile):
+                filename = f'{store.root}/fine/{var}/{var}_{row}_{col}.tif'
+                if Helper().check_file(filename):
+                    continue
+                lon0 = west + col * res
+                lat0 = north - row * res
+                shape = (min(tile, height - row), min(tile, width - col))
+                data = make_field(var, shape, lon0, lat0, res)
+                write_tiff(filename, data, lon0, lat0, res)
+
+
+def get_extent(domain, margin=1.):
+    # whole degrees around the domain, as for reproject = 'subset'
+    domain.reproject = 'subset'
+    extent = domain.get_reproject_extent(margin)
+    domain.reproject = 'global'
+    return extent
+
+
+def best_of(function, repeat=5):
+    # shortest run time in seconds, the mean is spoiled by other processes
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_hot_paths(workdir, domain, cells=200):
+    # the functions called per grid box, timed on the first cells of
+    # the domain
+    geo = Geo(domain)
+    soilgrids = Soilgrids(Store(domain.sg_cache))
+    soilgrids.initialize(domain.sg_res, domain.sg_tiles)
+    soilgrids.open()
+    if domain.sg_res != 'fine':
+        soilgrids.read_footprint(domain)
+    else:
+        soilgrids.read_footprint(domain, 0, 1)
+
+    rlon, rlat = np.meshgrid(domain.rlons, domain.rlats)
+    points = [(domain.rlons[i], domain.rlats[0])
+              for i in range(domain.ie_tot)][:cells]
+
+    corners = [geo.get_corners(*point) for point in points]
+    windows = [soilgrids.get_window(*corner) for corner in corners]
+    polygons = [np.array(list(zip(*corner))) for corner in corners]
+    reads = [soilgrids.read(*corner) for corner in corners]
+
+    def read():
+        for corner in corners:
+            soilgrids.read(*corner)
+
+    def mask_with_polygon():
+        for (box, int_box, lon, lat), polygon in zip(windows, polygons):
+            geo.mask_with_polygon(lon, lat, polygon)
+
+    def box_mean():
+        for sand, silt, clay, cfvo, lon, lat, landuse in reads:
+            soilgrids.box_mean(sand)
+
+    sand = np.random.default_rng(0).uniform(0, 1, rlon.shape)
+    silt = np.random.default_rng(1).uniform(0, 1, rlon.shape)
+    clay = np.random.default_rng(2).uniform(0, 1, rlon.shape)
+
+    data = [np.stack([field.astype(np.float32)])
+            for field in [sand, silt, clay, sand]]
+    output = Output(domain, data, f'{workdir}/hot_paths.nc')
+
+    timings = dict(
+        cells=len(points),
+        rot2geo=best_of(lambda: geo.rot2geo(rlon, rlat)),
+        mask_with_polygon=best_of(mask_with_polygon),
+        read=best_of(read),
+        box_mean=best_of(box_mean),
+        norm_mean=best_of(lambda: soilgrids.norm_mean(sand, silt, clay)),
+        write_netcdf=best_of(output.write_netcdf))
+
+    return timings
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # serves the bytes of data at any path, with range requests and an
+    # ETag that changes with the data
+    data = b''
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def get_etag():
+        return f'"{hashlib.sha256(RangeHandler.data).hexdigest()[:16]}"'
+
+    def send_data(self, body):
+        start, end = 0, len(self.data)
+        match = self.headers.get('Range', '').removeprefix('bytes=')
+        if match:
+            first, last = match.split('-')
+            start, end = int(first), min(int(last) + 1, len(self.data))
+
+        self.send_response(206 if match else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.get_etag())
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if body:
+            self.wfile.write(self.data[start:end])
+
+    def do_HEAD(self):
+        self.send_data(False)
+
+    def do_GET(self):
+        self.send_data(True)
+
+
+def bench_download(workdir, size=8 * 1024 * 1024, segment_size=1024 * 1024):
+    # seconds of each download case, the downloaded file is compared with
+    # the served bytes
+    rng = np.random.default_rng(0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/sand.tif'
+    local_path = f'{workdir}/download/sand.tif'
+    Helper().make_dir(os.path.dirname(local_path))
+
+    def download():
+        start = time.perf_counter()
+        Helper().download_file(url, local_path, segment_size=segment_size)
+        seconds = time.perf_counter() - start
+        with open(local_path, 'rb') as file:
+            if file.read() != RangeHandler.data:
+                print(f'ERROR: {local_path} differs from the served file')
+                exit()
+        os.remove(local_path)
+        return seconds
+
+    def interrupt():
+        # parts and record as left by a download stopped in the third
+        # segment
+        with open(f'{local_path}.parts.json', 'w') as file:
+            json.dump(dict(url=url, size=size, segment_size=segment_size,
+                           etag=RangeHandler.get_etag(),
+                           last_modified=None), file)
+        for k, length in enumerate([segment_size, segment_size,
+                                    segment_size // 2]):
+            with open(f'{local_path}.part{k}', 'wb') as file:
+                start = k * segment_size
+                file.write(RangeHandler.data[start:start + length])
+
+    try:
+        RangeHandler.data = rng.bytes(size)
+        timings = dict(complete=download())
+
+        interrupt()
+        timings['resumed'] = download()
+
+        # the parts of the old file are not mixed into the new one
+        interrupt()
+        RangeHandler.data = rng.bytes(size)
+        timings['changed'] = download()
+    finally:
+        server.shutdown()
+
+    return timings
+
+
+class FootprintCounter(Parallel):
+    # counts the row blocks that are read and not yet computed or in
+    # compute, i.e. the footprints in memory with the thread backend
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.live = 0
+        self.peak = 0
+
+    def read_block(self, block):
+        soilgrids = super().read_block(block)
+        with self.lock:
+            self.live += 1
+            self.peak = max(self.peak, self.live)
+        return soilgrids
+
+    def compute_block(self, block, soilgrids):
+        try:
+            return super().compute_block(block, soilgrids)
+        finally:
+            with self.lock:
+                self.live -= 1
+
+
+def bench_threads(workdir, resolution, size, processes=4, prefetch=2):
+    # thread backend on blocks of one row, the peak number of footprints
+    # in memory must not exceed prefetch + processes
+    domain, _ = make_domain(workdir, resolution, size, processes)
+    parallel = FootprintCounter()
+
+    start = time.perf_counter()
+    parallel.processing(domain, processes, block_rows=1, backend='thread')
+    seconds = time.perf_counter() - start
+
+    if parallel.peak > prefetch + processes:
+        print(f'ERROR: {parallel.peak} footprints in memory, at most '
+              f'{prefetch + processes} expected')
+        exit()
+
+    return dict(seconds=seconds, peak=parallel.peak,
+                limit=prefetch + processes)
+
+
+def run_pipeline(filename):
+    # full soil_init run in its own process, as from the command line
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'soil_init.py'), filename],
+        check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def compare(filename, reference):
+    # largest difference of the fields of two outputs, inf if the grid
+    # boxes without data differ, None without a reference
+    if not Helper().check_file(reference):
+        return None
+
+    diffs = {}
+    with Dataset(filename) as new, Dataset(reference) as old:
+        for var in VARIABLES:
+            a = np.ma.filled(new[var][:].astype(float), np.nan)
+            b = np.ma.filled(old[var][:].astype(float), np.nan)
+            same_nan = bool(np.array_equal(np.isnan(a), np.isnan(b)))
+            diff = np.nanmax(np.abs(a - b)) if same_nan else np.inf
+            diffs[var] = float(diff)
+
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--resolutions', nargs='+', default=['coarse'],
+                        choices=list(RESOLUTIONS))
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[16, 32, 64])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--workdir', default='./benchmark')
+    parser.add_argument('--compare', default=None,
+                        help='benchmark directory of an earlier version')
+    parser.add_argument('--results', default=None,
+                        help='JSON file, default {workdir}/results.json')
+    parser.add_argument('--download', action='store_true',
+                        help='check the download against a local server')
+    parser.add_argument('--threads', action='store_true',
+                        help='check the footprints of the thread backend')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    Helper().make_dir(workdir)
+
+    results = dict(sizes=args.sizes, workers=args.workers, runs=[],
+                   hot_paths={}, threads={})
+
+    if args.download:
+        results['download'] = bench_download(workdir)
+        print('download', results['download'])
+
+    for resolution in args.resolutions:
+        largest, _ = make_domain(workdir, resolution, max(args.sizes))
+        start = time.perf_counter()
+        make_rasters(workdir, resolution, get_extent(largest))
+        print(f'{resolution}: rasters made in '
+              f'{time.perf_counter() - start:.1f} s')
+
+        results['hot_paths'][resolution] = bench_hot_paths(workdir, largest)
+        print(resolution, results['hot_paths'][resolution])
+
+        if args.threads:
+            results['threads'][resolution] = bench_threads(
+                workdir, resolution, max(args.sizes))
+            print(resolution, 'threads', results['threads'][resolution])
+
+        for size in args.sizes:
+            for processes in args.workers:
+                domain, filename = make_domain(workdir, resolution, size,
+                                               processes)
+                seconds = run_pipeline(filename)
+
+                run = dict(resolution=resolution, size=size,
+                           processes=processes, seconds=seconds,
+                           cells_per_second=size * size / seconds)
+                with open(domain.report) as file:
+                    run['report'] = json.load(file)
+                if args.compare is not None:
+                    run['max_diff'] = compare(domain.output, os.path.join(
+                        args.compare, os.path.basename(domain.output)))
+
+                results['runs'].append(run)
+                print(f'{resolution} {size}x{size} {processes} workers: '
+                      f'{seconds:.2f} s', run.get('max_diff', ''))
+
+    filename = args.results or f'{workdir}/results.json'
+    with open(filename, 'w') as file:
+        json.dump(results, file, indent=1)
+    print(f'results written to {filename}')
+
+
+if __name__ == '__main__':
+    main()
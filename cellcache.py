@@ -0,0 +1,107 @@
+import hashlib
+import os
+import numpy as np
+
+from helper import Helper
+from store import Store
+
+
+class CellCache:
+    """
+    Results of single grid boxes, kept between runs.
+
+    A grid box is identified by its centre in rotated coordinates and the
+    settings of its grid (rotated pole, dx, sg_res, weighting, layers,
+    rasters, land-use classes), so a domain that is moved, enlarged or
+    nested into another one on the same grid only computes the boxes not
+    seen before. All boxes of one grid are kept in one .npz file with
+    their centres, the fields before normalization and the land-use class
+    fractions; several jobs can add to it at once.
+    """
+
+    # centres are compared in units of 1e-8 degrees, startlon + i * dx
+    # differs in the last bits between shifted domains
+    scale = 1e8
+
+    def __init__(self, domain, path=None):
+        self.domain = domain
+        self.path = domain.cell_cache if path is None else path
+        self.filename = f'{self.path}/{self.get_key()}.npz'
+
+    def get_key(self):
+        # the reprojected pixels are the same for all extents, reproject
+        # and the memory maps do not change the results; the rasters are
+        # whatever the store, tile and land-use paths point to
+        domain = self.domain
+        settings = (domain.dx, domain.pol_lon, domain.pol_lat, domain.sg_res,
+                    domain.weighting, domain.get_layers(),
+                    domain.get_rasters(), domain.get_classes())
+
+        return hashlib.sha256(repr(settings).encode()).hexdigest()[:16]
+
+    def get_centres(self):
+        # integer centres of all grid boxes of the domain, (je_tot, ie_tot, 2)
+        rlons, rlats = np.meshgrid(self.domain.rlons, self.domain.rlats)
+        centres = np.stack([rlons, rlats], axis=-1) * self.scale
+
+        return np.rint(centres).astype(np.int64)
+
+    def read(self):
+        # centres (n, 2), fields (n, 4, layers) and fractions (n, classes)
+        # of the known grid boxes
+        if not Helper().check_file(self.filename):
+            nlayers = len(self.domain.get_layers())
+            nclasses = len(self.domain.get_classes())
+            return (np.zeros((0, 2), dtype=np.int64),
+                    np.zeros((0, 4, nlayers), dtype=np.float32),
+                    np.zeros((0, nclasses), dtype=np.float32))
+
+        with np.load(self.filename) as cells:
+            return cells['centres'], cells['data'], cells['fractions']
+
+    def get_index(self, centres):
+        return {(x, y): k for k, (x, y) in enumerate(centres.tolist())}
+
+    def load(self, data, fractions):
+        # put the known grid boxes into data (4, layers, je_tot, ie_tot) and
+        # fractions (classes, je_tot, ie_tot), returns the mask of the grid
+        # boxes still to compute
+        centres, cells, cell_fractions = self.read()
+        index = self.get_index(centres)
+
+        found = [(j, i, index[x, y])
+                 for j, row in enumerate(self.get_centres().tolist())
+                 for i, (x, y) in enumerate(row) if (x, y) in index]
+
+        todo = np.ones(data.shape[2:], dtype=bool)
+        if found:
+            jj, ii, kk = np.array(found).T
+            data[:, :, jj, ii] = cells[kk].transpose(1, 2, 0)
+            fractions[:, jj, ii] = cell_fractions[kk].T
+            todo[jj, ii] = False
+
+        return todo
+
+    def save(self, data, fractions):
+        # add the grid boxes of the domain that are not known yet; the
+        # file is read again under the lock, other jobs may have added to it
+        Helper().make_dir(self.path)
+
+        nlayers = data.shape[1]
+        centres = self.get_centres().reshape(-1, 2)
+        values = data.reshape(4, nlayers, -1).transpose(2, 0, 1)
+        shares = fractions.reshape(fractions.shape[0], len(centres)).T
+
+        with Store(self.path).lock(self.filename):
+            known, cells, cell_fractions = self.read()
+            index = self.get_index(known)
+            new = [k for k, (x, y) in enumerate(centres.tolist())
+                   if (x, y) not in index]
+            if not new:
+                return
+
+            tmpfile = f'{self.filename}.tmp.npz'
+            np.savez(tmpfile, centres=np.concatenate([known, centres[new]]),
+                     data=np.concatenate([cells, values[new]]),
+                     fractions=np.concatenate([cell_fractions, shares[new]]))
+            os.replace(tmpfile, self.filename)
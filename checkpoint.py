@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from helper import Helper
+
+
+class Checkpoint:
+    """
+    Finished row blocks of a run, saved as they arrive.
+
+    Each block is an .npz file with the fields before normalization, the
+    valid mask and the land-use class fractions. A later run of the same
+    domain skips these blocks. The key in meta.json covers everything the
+    blocks depend on; a directory with another key is cleared.
+    """
+
+    def __init__(self, domain, path=None):
+        self.domain = domain
+        self.path = f'{domain.output}.checkpoint' if path is None else path
+        self.meta = f'{self.path}/meta.json'
+
+    def get_key(self, block_rows):
+        domain = self.domain
+        settings = (domain.dx, domain.pol_lon, domain.pol_lat,
+                    domain.ie_tot, domain.je_tot,
+                    domain.startlat, domain.startlon, domain.sg_res,
+                    domain.weighting, domain.get_layers(),
+                    domain.get_rasters(), domain.get_classes(), block_rows)
+
+        return hashlib.sha256(repr(settings).encode()).hexdigest()[:16]
+
+    def open(self, block_rows):
+        key = self.get_key(block_rows)
+
+        if Helper().check_file(self.meta):
+            with open(self.meta) as file:
+                if json.load(file)['key'] == key:
+                    return
+            print(f'{self.path} is from other settings, removing it')
+            self.remove()
+
+        Helper().make_dir(self.path)
+        with open(self.meta, 'w') as file:
+            json.dump(dict(key=key), file)
+
+    def get_filename(self, j0, j1):
+        return f'{self.path}/{j0}_{j1}.npz'
+
+    def get_done(self, blocks):
+        # blocks with a complete file
+        return [(j0, j1) for j0, j1 in blocks
+                if Helper().check_file(self.get_filename(j0, j1))]
+
+    def save(self, j0, j1, data, valid, fractions):
+        # written to a temporary file first, a block file is always complete
+        filename = self.get_filename(j0, j1)
+        tmpfile = f'{filename}.tmp.npz'
+        np.savez(tmpfile, data=data, valid=valid, fractions=fractions)
+        os.replace(tmpfile, filename)
+
+    def load(self, j0, j1):
+        with np.load(self.get_filename(j0, j1)) as block:
+            return block['data'], block['valid'], block['fractions']
+
+    def remove(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
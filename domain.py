@@ -1,4 +1,7 @@
+import os
 import sys
+import types
+import numpy as np
 from importlib.machinery import SourceFileLoader
 
 from geo import Geo
@@ -20,6 +23,28 @@ class Domain:
         self.end_date = None
         self.sg_res = None
 
+        # optional settings
+        self.remap = False
+        self.weighting = 'mask'
+        self.output = 'output.nc'
+        self.sg_tiles = './soilgrids/fine'
+        self.reproject = 'global'
+        self.sg_cache = './soilgrids'
+        self.sg_cache_gb = None
+        self.sg_depths = ['0-5cm']
+        self.sg_stats = ['mean']
+        self.sg_memmap = False
+        self.report = None
+        self.cprofile = None
+        self.processes = 10
+        self.checkpoint = True
+        self.tiles = (1, 1)
+        self.backend = 'process'
+        self.cell_cache = None
+        self.interpolation = 'box'
+        self.landuse = None
+        self.landuse_classes = None
+
         self.rlons = None
         self.rlats = None
 
@@ -44,8 +69,17 @@ class Domain:
 
         self.check_domain_file(dfilename)
 
-        dfile = SourceFileLoader('d', dfilename).load_module()
+        # a new module for every file, settings of a domain file read
+        # before must not be kept
+        loader = SourceFileLoader('d', dfilename)
+        dfile = types.ModuleType(loader.name)
+        loader.exec_module(dfile)
+
+        self.read_settings(dfile)
 
+    def read_settings(self, dfile):
+        # dfile: the loaded domain file or any object with the same
+        # attributes, e.g. types.SimpleNamespace(**settings)
         self.name = dfile.name
         self.dx = dfile.dx
         self.pol_lon = dfile.pol_lon
@@ -59,18 +93,190 @@ class Domain:
         self.end_date = dfile.end_date
         self.sg_res = dfile.sg_res
 
+        self.remap = getattr(dfile, 'remap', self.remap)
+        self.weighting = getattr(dfile, 'weighting', self.weighting)
+        self.check_weighting()
+        self.output = getattr(dfile, 'output', self.output)
+        self.sg_tiles = getattr(dfile, 'sg_tiles', self.sg_tiles)
+        self.reproject = getattr(dfile, 'reproject', self.reproject)
+        self.sg_cache = getattr(dfile, 'sg_cache', self.sg_cache)
+        self.sg_cache_gb = getattr(dfile, 'sg_cache_gb', self.sg_cache_gb)
+        self.sg_depths = getattr(dfile, 'sg_depths', self.sg_depths)
+        self.sg_stats = getattr(dfile, 'sg_stats', self.sg_stats)
+        self.sg_memmap = getattr(dfile, 'sg_memmap', self.sg_memmap)
+        # JSON report of the metrics and cProfile output of the run
+        self.report = getattr(dfile, 'report', self.report)
+        self.cprofile = getattr(dfile, 'cprofile', self.cprofile)
+        self.processes = getattr(dfile, 'processes', self.processes)
+        # keep finished row blocks in {output}.checkpoint until the run
+        # is complete
+        self.checkpoint = getattr(dfile, 'checkpoint', self.checkpoint)
+        # (tiles_x, tiles_y) for independent tile jobs, see Partition
+        self.tiles = tuple(getattr(dfile, 'tiles', self.tiles))
+        self.backend = getattr(dfile, 'backend', self.backend)
+        self.check_backend()
+        # directory of the results of single grid boxes, see CellCache
+        self.cell_cache = getattr(dfile, 'cell_cache', self.cell_cache)
+        # box: mean over the grid box; nearest or bilinear: quick-look
+        # values at the centre of the grid box
+        self.interpolation = getattr(dfile, 'interpolation',
+                                     self.interpolation)
+        self.check_interpolation()
+        # land-use raster, only its pixels of landuse_classes are averaged
+        # and the fraction of each class is written
+        self.landuse = getattr(dfile, 'landuse', self.landuse)
+        self.landuse_classes = getattr(dfile, 'landuse_classes',
+                                       self.landuse_classes)
+        self.check_remap()
+        self.check_reproject()
+        self.check_layers()
+        self.check_memmap()
+        self.check_tiles()
+        self.check_landuse()
+
+    def check_weighting(self):
+        if self.weighting not in ['mask', 'area']:
+            print('weighting must be mask or area; exit')
+            exit()
+
+    def check_remap(self):
+        # the remapping needs the footprint of the whole domain in memory
+        if self.remap and self.sg_res == 'fine':
+            print('remap is not possible with sg_res = fine; exit')
+            exit()
+
+    def check_reproject(self):
+        if self.reproject not in ['global', 'subset', 'direct']:
+            print('reproject must be global, subset or direct; exit')
+            exit()
+        if self.reproject == 'direct' and self.sg_res == 'fine':
+            print('reproject = direct is not possible with sg_res = fine; '
+                  'exit')
+            exit()
+
+    def check_layers(self):
+        depths = ['0-5cm', '5-15cm', '15-30cm', '30-60cm', '60-100cm',
+                  '100-200cm']
+        stats = ['mean', 'Q0.05', 'Q0.5', 'Q0.95', 'uncertainty']
+        if not self.sg_depths or \
+                any(depth not in depths for depth in self.sg_depths):
+            print('sg_depths must be a list of ' + ', '.join(depths) +
+                  '; exit')
+            exit()
+        if not self.sg_stats or \
+                any(statistic not in stats for statistic in self.sg_stats):
+            print('sg_stats must be a list of ' + ', '.join(stats) + '; exit')
+            exit()
+
+    def check_memmap(self):
+        # the memory maps are made from the EPSG:4326 files
+        if self.sg_memmap and self.sg_res == 'fine':
+            print('sg_memmap is not possible with sg_res = fine; exit')
+            exit()
+        if self.sg_memmap and self.reproject == 'direct':
+            print('sg_memmap is not possible with reproject = direct; exit')
+            exit()
+
+    def check_interpolation(self):
+        if self.interpolation not in ['box', 'nearest', 'bilinear']:
+            print('interpolation must be box, nearest or bilinear; exit')
+            exit()
+        # the centres are sampled from the EPSG:4326 files
+        if self.interpolation != 'box' and self.reproject == 'direct':
+            print(f'interpolation = {self.interpolation} is not possible '
+                  'with reproject = direct; exit')
+            exit()
+
+    def check_landuse(self):
+        if self.landuse is None:
+            return
+        if not Helper().check_file(self.landuse):
+            print('ERROR: land-use raster "'+self.landuse+'" not found')
+            exit()
+        if not self.landuse_classes or \
+                any(not isinstance(c, int) for c in self.landuse_classes):
+            print('landuse_classes must be a list of land-use classes; exit')
+            exit()
+        # the classes mask the pixels of each grid box in Parallel.get
+        if self.remap or self.reproject == 'direct' or \
+                self.interpolation != 'box':
+            print('landuse is only possible with interpolation = box, '
+                  'without remap or reproject = direct; exit')
+            exit()
+
+    def check_backend(self):
+        if self.backend not in ['process', 'thread']:
+            print('backend must be process or thread; exit')
+            exit()
+
+    def check_tiles(self):
+        if len(self.tiles) != 2 or \
+                not 1 <= self.tiles[0] <= self.ie_tot or \
+                not 1 <= self.tiles[1] <= self.je_tot:
+            print('tiles must be (tiles_x, tiles_y) with at most ie_tot x '
+                  'je_tot tiles; exit')
+            exit()
+
+    def get_classes(self):
+        # land-use classes with a fraction field, none without land use
+        if self.landuse is None:
+            return []
+        return list(self.landuse_classes)
+
+    def get_rasters(self):
+        # absolute paths of the rasters the results are computed from: the
+        # 250m tiles or the store, and the land use
+        rasters = os.path.abspath(self.sg_tiles if self.sg_res == 'fine'
+                                  else self.sg_cache)
+        landuse = None
+        if self.landuse is not None:
+            landuse = os.path.abspath(self.landuse)
+
+        return rasters, landuse
+
+    def get_layers(self):
+        # all (depth, statistic) pairs, extracted together in one pass
+        return [(depth, statistic) for depth in self.sg_depths
+                for statistic in self.sg_stats]
+
+    def get_reproject_extent(self, margin=1.):
+        # geographical extent of the domain plus a margin in degrees,
+        # rounded outwards to whole degrees to share it between similar
+        # domains; None for the global reprojection
+        if self.reproject != 'subset':
+            return None
+
+        elongeo, elatgeo = self.get_edge(offset=1)
+
+        return (max(np.floor(np.min(elongeo) - margin), -180.),
+                max(np.floor(np.min(elatgeo) - margin), -90.),
+                min(np.ceil(np.max(elongeo) + margin), 180.),
+                min(np.ceil(np.max(elatgeo) + margin), 90.))
+
     def get_rlons_rlats(self):
         self.rlons = [self.startlon + i * self.dx
                       for i in range(self.ie_tot)]
         self.rlats = [self.startlat + i * self.dx
                       for i in range(self.je_tot)]
 
-    def get_edge(self, offset=0):
-        # define edge of the domain for the first rough cut out
+    def get_box(self, j0=0, j1=None):
+        # geographical bounding box of the footprint of the domain (or of
+        # the rlat rows j0:j1)
+        elongeo, elatgeo = self.get_edge(offset=1, j0=j0, j1=j1)
+
+        return [(np.min(elongeo), np.min(elatgeo)),
+                (np.max(elongeo), np.max(elatgeo))]
+
+    def get_edge(self, offset=0, j0=0, j1=None):
+        # define edge of the domain (or of the rlat rows j0:j1)
+        # for the first rough cut out
+        if j1 is None:
+            j1 = self.je_tot
+
         rlons = [self.startlon + i * self.dx
                  for i in range(-offset, self.ie_tot+offset)]
         rlats = [self.startlat + i * self.dx
-                 for i in range(-offset, self.je_tot+offset)]
+                 for i in range(j0-offset, j1+offset)]
 
         # southers edge
         edgelon = [rlons[i] for i in range(len(rlons))]
@@ -88,8 +294,7 @@ class Domain:
         edgelon += [rlons[-1]]*len(rlats)
         edgelat += rlats
 
-        (elongeo, elatgeo) = Geo().rot2geo(edgelon, edgelat,
-                                           self.pol_lon, self.pol_lat)
+        (elongeo, elatgeo) = Geo(self).rot2geo(edgelon, edgelat)
 
         # xgeomin = np.min(elongeo)
         # xgeomax = np.max(elongeo)
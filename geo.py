@@ -7,67 +7,67 @@ class Geo:
         self.domain = domain
 
     def rot2geo(self, xin, yin):
+        # works on scalars and arrays of any shape
+        singlepoint = np.ndim(xin) == 0
 
         pollon = self.domain.pol_lon
         pollat = self.domain.pol_lat
 
-        xgeo = [i for i in xin]
-        ygeo = [i for i in yin]
-
         pi_r = np.pi/180.
 
-        for i in range(len(xin)):
-            ygeo[i] = 1./pi_r * np.arcsin(
-                np.sin(pi_r*yin[i])*np.sin(pi_r*pollat) +
-                np.cos(pi_r*yin[i])*np.cos(pi_r*xin[i]) *
-                np.cos(pi_r*pollat))
+        xin = pi_r * np.asarray(xin, dtype=float)
+        yin = pi_r * np.asarray(yin, dtype=float)
 
-            xgeo[i] = 1./pi_r * np.arctan(
-                (np.cos(pi_r*yin[i])*np.sin(pi_r*xin[i])) /
-                (np.sin(pi_r*pollat)*np.cos(pi_r*yin[i]) *
-                 np.cos(pi_r*xin[i])-np.sin(pi_r*yin[i]) *
-                 np.cos(pi_r*pollat))) + pollon + 180.
+        ygeo = 1./pi_r * np.arcsin(
+            np.sin(yin)*np.sin(pi_r*pollat) +
+            np.cos(yin)*np.cos(xin)*np.cos(pi_r*pollat))
 
-            if xgeo[i] > 180.:
-                xgeo[i] -= 360.
+        xgeo = 1./pi_r * np.arctan2(
+            np.cos(yin)*np.sin(xin),
+            np.sin(pi_r*pollat)*np.cos(yin)*np.cos(xin) -
+            np.sin(yin)*np.cos(pi_r*pollat)) + pollon + 180.
 
-        return (xgeo, ygeo)
+        xgeo = np.where(xgeo > 180., xgeo - 360., xgeo)
+        xgeo = np.where(xgeo < -180., xgeo + 360., xgeo)
 
-    def geo2rot(self, xin, yin):
+        if singlepoint:
+            return float(xgeo), float(ygeo)
+        else:
+            return xgeo, ygeo
 
-        singlepoint = None
+    def geo2rot(self, xin, yin):
+        # works on scalars and arrays of any shape
+        singlepoint = np.ndim(xin) == 0
 
         pollon = self.domain.pol_lon
         pollat = self.domain.pol_lat
 
-        if type(xin) is float or type(xin) is int:
-            singlepoint = True
-            xin = [xin]
-            yin = [yin]
-
-        xrot = [None] * len(xin)
-        yrot = [None] * len(yin)
-
         pi_r = np.pi/180.
 
-        for i in range(len(xin)):
+        xin = pi_r * (np.asarray(xin, dtype=float) - pollon)
+        yin = pi_r * np.asarray(yin, dtype=float)
 
-            yrot[i] = 1./pi_r * np.arcsin(
-                np.sin(pi_r*yin[i])*np.sin(pi_r*pollat) +
-                np.cos(pi_r*yin[i])*np.cos(pi_r*pollat) *
-                np.cos(pi_r*(xin[i]-pollon)))
+        yrot = 1./pi_r * np.arcsin(
+            np.sin(yin)*np.sin(pi_r*pollat) +
+            np.cos(yin)*np.cos(pi_r*pollat)*np.cos(xin))
 
-            xrot[i] = 1./pi_r * np.arctan(
-                (np.cos(pi_r*yin[i])*np.sin(pi_r*(xin[i]-pollon))) /
-                (np.cos(pi_r*yin[i])*np.sin(pi_r*pollat) *
-                 np.cos(pi_r*(xin[i]-pollon)) -
-                 np.sin(pi_r*yin[i])*np.cos(pi_r*pollat)))
+        xrot = 1./pi_r * np.arctan2(
+            -np.cos(yin)*np.sin(xin),
+            np.sin(yin)*np.cos(pi_r*pollat) -
+            np.cos(yin)*np.sin(pi_r*pollat)*np.cos(xin))
 
         if singlepoint:
-            return xrot[0], yrot[0]
+            return float(xrot), float(yrot)
         else:
             return xrot, yrot
 
+    def get_proj4(self):
+        # rotated pole grid of the domain as PROJ string, in degrees
+        return ('+proj=ob_tran +o_proj=longlat +o_lon_p=0 '
+                f'+o_lat_p={self.domain.pol_lat} '
+                f'+lon_0={180. + self.domain.pol_lon} '
+                '+datum=WGS84 +to_meter=0.0174532925199433 +no_defs')
+
     def get_corners(self, rlon, rlat):
 
         dx = self.domain.dx
@@ -86,50 +86,105 @@ class Geo:
 
         return corner_x, corner_y
 
+    def get_weights(self, lons, lats, polygon_vertices):
+        # weight of each pixel in the mean of the grid box
+        if self.domain.weighting == 'area':
+            return self.area_weights(lons, lats, polygon_vertices)
+        else:
+            mask = self.mask_with_polygon(lons, lats, polygon_vertices)
+            return (~mask).astype(float)
+
     def mask_with_polygon(self, lons, lats, polygon_vertices):
-        m = len(lons) - 1
-        n = len(lats) - 1
+        lons = np.asarray(lons)
+        lats = np.asarray(lats)
 
         # Create the path for the polygon
         polygon_path = mpath.Path(polygon_vertices)
 
-        # Create a mask array
-        extended_mask = np.zeros((n, m), dtype=bool)
-        extended_mask[:, :] = True
+        # Check all pixel corners at once, each pixel (j, i) has the corners
+        # (i, j), (i, j+1), (i+1, j+1) and (i+1, j)
+        corner_lons, corner_lats = np.meshgrid(lons, lats)
+        corners = np.column_stack((corner_lons.ravel(), corner_lats.ravel()))
+        inside = polygon_path.contains_points(corners).reshape(
+            corner_lons.shape).astype(int)
+        corner_count = (inside[:-1, :-1] + inside[1:, :-1] +
+                        inside[1:, 1:] + inside[:-1, 1:])
+
+        # If at least 3 out of 4 corners are inside, the pixel is inside
+        extended_mask = corner_count < 3
+
+        # Perform detailed sampling where the corner check is inconclusive
+        jj, ii = np.nonzero(extended_mask)
+        if len(ii) == 0:
+            return extended_mask
 
         # Define the sampling points within each pixel (center and midpoints of edges)
-        sampling_points_detailed = [
+        sampling_points_detailed = np.array([
             (0.1, 0.1), (0.1, 0.5), (0.1, 0.9),
             (0.5, 0.1), (0.5, 0.5), (0.5, 0.9),
             (0.9, 0.1), (0.9, 0.5), (0.9, 0.9)
-        ]
-
-        # Check each pixel
-        for i in range(m):
-            for j in range(n):
-                corners = [
-                    (lons[i], lats[j]),
-                    (lons[i], lats[j+1]),
-                    (lons[i+1], lats[j+1]),
-                    (lons[i+1], lats[j]),
-                ]
-                corner_count = sum(polygon_path.contains_points(corners))
-
-                # If at least 3 out of 4 corners are inside, the pixel is inside
-                if corner_count >= 3:
-                    extended_mask[j, i] = False
-                else:
-                    # Perform detailed sampling if corner check is inconclusive
-                    count = 0
-                    for dx, dy in sampling_points_detailed:
-                        sample_lon = lons[i] + dx * \
-                            (lons[i+1] - lons[i])
-                        sample_lat = lats[j] + dy * \
-                            (lats[j+1] - lats[j])
-                        if polygon_path.contains_point((sample_lon, sample_lat)):
-                            count += 1
-                    # More than 50% means at least 5 out of 9 points
-                    if count >= 5:
-                        extended_mask[j, i] = False
+        ])
+
+        sample_lon = lons[ii, None] + sampling_points_detailed[None, :, 0] * \
+            (lons[ii+1, None] - lons[ii, None])
+        sample_lat = lats[jj, None] + sampling_points_detailed[None, :, 1] * \
+            (lats[jj+1, None] - lats[jj, None])
+        samples = np.column_stack((sample_lon.ravel(), sample_lat.ravel()))
+        count = polygon_path.contains_points(samples).reshape(
+            sample_lon.shape).sum(axis=1)
+
+        # More than 50% means at least 5 out of 9 points
+        extended_mask[jj, ii] = count < 5
 
         return extended_mask
+
+    def quadrant_area(self, a, b, polygon_vertices):
+        # area of the polygon in the quadrant x <= a, y <= b for all a, b,
+        # from Green's theorem: the line integral of min(x, a) [y <= b] dy
+        # along the polygon edges
+        x0 = polygon_vertices[:, 0]
+        y0 = polygon_vertices[:, 1]
+        x1 = np.roll(x0, -1)
+        y1 = np.roll(y0, -1)
+
+        a = a[..., None]
+        b = b[..., None]
+
+        # the part of each edge below b, as a fraction of the edge
+        ylo = np.minimum(y0, y1)
+        yhi = np.maximum(y0, y1)
+        ytop = np.minimum(yhi, b)
+        length = np.maximum(ytop - ylo, 0.)
+
+        # x at both ends of the clipped part of the edge
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = np.where(yhi > ylo, (x1 - x0) / (y1 - y0), 0.)
+        xa = x0 + slope * (ylo - y0)
+        xb = x0 + slope * (ytop - y0)
+
+        # mean of min(x, a) along the clipped part of the edge
+        xmin = np.minimum(xa, xb)
+        xmax = np.maximum(xa, xb)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip((a - xmin) / (xmax - xmin), 0., 1.)
+        mean = np.where(xmax <= a, (xa + xb) / 2.,
+                        np.where(xmin >= a, a,
+                                 t * (xmin + a) / 2. + (1. - t) * a))
+
+        return np.sum(np.sign(y1 - y0) * length * mean, axis=-1)
+
+    def area_weights(self, lons, lats, polygon_vertices):
+        # fraction of each pixel covered by the polygon
+        lons = np.asarray(lons)
+        lats = np.asarray(lats)
+        polygon_vertices = np.asarray(polygon_vertices, dtype=float)
+
+        corner_lons, corner_lats = np.meshgrid(lons, lats)
+        area = self.quadrant_area(corner_lons, corner_lats, polygon_vertices)
+
+        # the signs depend on the orientation of the polygon and the axes
+        overlap = np.abs(area[:-1, :-1] - area[1:, :-1] -
+                         area[:-1, 1:] + area[1:, 1:])
+        pixel_area = np.abs(np.outer(np.diff(lats), np.diff(lons)))
+
+        return np.clip(overlap / pixel_area, 0., 1.)
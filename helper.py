@@ -1,4 +1,8 @@
+import glob
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 
@@ -10,22 +14,145 @@ class Helper:
         if not os.path.isdir(name):
             os.makedirs(name)
 
-    def download_file(self, url, local_path):
+    def download_file(self, url, local_path, parts=4,
+                      segment_size=32 * 1024 * 1024, position=0):
+        # the file is downloaded in segments of segment_size bytes, each to
+        # its own .part file, up to parts of them in parallel HTTP range
+        # requests. An interrupted download continues where the .part
+        # files end if the file on the server is still the same.
+        # local_path only exists once the size is verified.
         import requests
-        response = requests.get(url, stream=True)
+        response = requests.head(url, allow_redirects=True)
+        response.raise_for_status()
 
         total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024  # 1 KB
-
-        with open(local_path, 'wb') as file, tqdm(
-                desc="Downloading",
-                total=total_size,
-                unit='B',
-                unit_scale=True,
-                unit_divisor=1024,
-                miniters=1) as bar:
+        ranges = response.headers.get('accept-ranges') == 'bytes'
+
+        if ranges and total_size > 0:
+            segments = [(start, min(start + segment_size, total_size))
+                        for start in range(0, total_size, segment_size)]
+        else:
+            # no range requests, the whole file in one segment
+            segments = [(0, None)]
+
+        partfiles = [f'{local_path}.part{k}' for k in range(len(segments))]
+        record = dict(url=url, size=total_size, segment_size=segment_size,
+                      etag=response.headers.get('etag'),
+                      last_modified=response.headers.get('last-modified'))
+        self.check_parts(local_path, record, segments)
+
+        with tqdm(desc=f"Downloading {os.path.basename(local_path)}",
+                  total=total_size,
+                  unit='B',
+                  unit_scale=True,
+                  unit_divisor=1024,
+                  position=position,
+                  miniters=1) as bar:
+            with ThreadPoolExecutor(max_workers=parts) as executor:
+                futures = [executor.submit(self.download_segment, url,
+                                           partfile, start, end, bar)
+                           for partfile, (start, end)
+                           in zip(partfiles, segments)]
+                for future in futures:
+                    future.result()
+
+        # join the segments and check the size before the file is used
+        tmpfile = f'{local_path}.tmp'
+        sha256 = hashlib.sha256()
+        with open(tmpfile, 'wb') as file:
+            for partfile in partfiles:
+                with open(partfile, 'rb') as part:
+                    for data in iter(lambda: part.read(1024 * 1024), b''):
+                        sha256.update(data)
+                        file.write(data)
+
+        size = os.path.getsize(tmpfile)
+        if total_size > 0 and size != total_size:
+            os.remove(tmpfile)
+            for partfile in partfiles:
+                os.remove(partfile)
+            print(f'ERROR: download of {url} incomplete, {size} of '
+                  f'{total_size} bytes; exit')
+            exit()
+
+        with open(f'{local_path}.sha256', 'w') as file:
+            file.write(f'{sha256.hexdigest()}  {size}\n')
+        os.replace(tmpfile, local_path)
+
+        for partfile in partfiles:
+            os.remove(partfile)
+        os.remove(f'{local_path}.parts.json')
+
+        print(f"{os.path.basename(local_path)} downloaded successfully.\n")
+
+    def check_parts(self, local_path, record, segments):
+        # the .part files of an earlier download are only continued if
+        # they belong to the same file on the server, recorded with its
+        # size, ETag and Last-Modified in {local_path}.parts.json; parts
+        # without a record, of another version of the file or larger
+        # than their segment are removed
+        recordfile = f'{local_path}.parts.json'
+        old = None
+        if self.check_file(recordfile):
+            with open(recordfile) as file:
+                old = json.load(file)
+
+        for partfile in glob.glob(f'{glob.escape(local_path)}.part[0-9]*'):
+            k = int(partfile.rsplit('.part', 1)[1])
+            start, end = segments[k] if k < len(segments) else (0, 0)
+            if old != record or end is None or \
+                    os.path.getsize(partfile) > end - start:
+                os.remove(partfile)
+
+        with open(recordfile, 'w') as file:
+            json.dump(record, file, indent=1)
+
+    def download_segment(self, url, partfile, start, end, bar,
+                         block_size=1024 * 1024):
+        import requests
+        # resume after the bytes already in the .part file
+        done = os.path.getsize(partfile) if self.check_file(partfile) else 0
+
+        if end is None:
+            # without range requests the segment starts again
+            done = 0
+            headers = {}
+        elif start + done >= end:
+            bar.update(done)
+            return
+        else:
+            headers = {'Range': f'bytes={start + done}-{end - 1}'}
+
+        bar.update(done)
+
+        response = requests.get(url, stream=True, headers=headers)
+        response.raise_for_status()
+
+        if headers and response.status_code != 206:
+            print(f'ERROR: {url} ignores the range request; exit')
+            exit()
+
+        with open(partfile, 'ab' if done else 'wb') as file:
             for data in response.iter_content(block_size):
                 bar.update(len(data))
                 file.write(data)
 
-        print("File downloaded successfully.\n")
+    def check_download(self, filename):
+        # compare a downloaded file with the size and checksum recorded
+        # after the download, files without a record are accepted
+        checkfile = f'{filename}.sha256'
+        if not self.check_file(checkfile):
+            return True
+
+        with open(checkfile) as file:
+            checksum, size = file.read().split()
+
+        if os.path.getsize(filename) != int(size):
+            return False
+
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for data in iter(lambda: file.read(1024 * 1024), b''):
+                sha256.update(data)
+
+        return sha256.hexdigest() == checksum
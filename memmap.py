@@ -0,0 +1,78 @@
+import json
+import os
+import numpy as np
+import rasterio
+
+from tiles import Tiles
+
+
+class Memmap(Tiles):
+    """
+    Uncompressed EPSG:4326 raster in a .npy file, opened as a read-only
+    memory map, with the georeferencing in a .json sidecar.
+
+    Boxes are returned as views of the memory map, nothing is decoded or
+    copied, and all processes reading the same file share its pages in
+    the page cache. Made from a GeoTIFF once by convert.
+    """
+
+    def __init__(self, path, nodata=-32768):
+        self.path = path
+
+        with open(f'{path}.json') as file:
+            meta = json.load(file)
+
+        self.left = meta['left']
+        self.top = meta['top']
+        self.dx = meta['dx']
+        self.dy = meta['dy']
+        self.nodata = meta.get('nodata', nodata)
+
+        self.data = np.load(path, mmap_mode='r')
+        self.dtype = self.data.dtype
+        self.height, self.width = self.data.shape
+
+    @staticmethod
+    def convert(input_file, output_file, band=1):
+        # the array is written block by block of the GeoTIFF, the file
+        # is only in place once it is complete
+        with rasterio.open(input_file) as src:
+            meta = dict(left=src.bounds.left, top=src.bounds.top,
+                        dx=src.res[0], dy=src.res[1],
+                        nodata=src.nodata if src.nodata is not None
+                        else -32768)
+
+            tmpfile = f'{output_file}.tmp'
+            data = np.lib.format.open_memmap(
+                tmpfile, mode='w+', dtype=src.dtypes[0],
+                shape=(src.height, src.width))
+
+            for _, window in src.block_windows(band):
+                data[window.row_off:window.row_off + window.height,
+                     window.col_off:window.col_off + window.width] = \
+                    src.read(band, window=window)
+
+            data.flush()
+            del data
+
+        with open(f'{output_file}.json', 'w') as file:
+            json.dump(meta, file, indent=1)
+        os.replace(tmpfile, output_file)
+
+    def read_int_box(self, int_box):
+        ((i_min, j_min), (i_max, j_max)) = int_box
+
+        if i_min >= 0 and j_min >= 0 and \
+                i_max <= self.width and j_max <= self.height:
+            return self.data[j_min:j_max, i_min:i_max]
+
+        # boxes over the edge of the raster are filled with nodata
+        data = np.full((j_max - j_min, i_max - i_min), self.nodata,
+                       dtype=self.dtype)
+        c0, c1 = max(i_min, 0), min(i_max, self.width)
+        r0, r1 = max(j_min, 0), min(j_max, self.height)
+        if c0 < c1 and r0 < r1:
+            data[r0 - j_min:r1 - j_min, c0 - i_min:c1 - i_min] = \
+                self.data[r0:r1, c0:c1]
+
+        return data
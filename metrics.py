@@ -0,0 +1,83 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Named timers and counters of one process.
+
+    Every process has its own instance (metrics below), the workers send
+    theirs with each finished row block and the main process writes all
+    of them into one JSON report.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+        # timers and counters are also updated from threads
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def timer(self, name):
+        # the time spent in the block is added to the timer name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.timers[name] = self.timers.get(name, 0.) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_peak_rss(self):
+        # maximum resident set size of the process in MB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def get_stats(self):
+        return dict(pid=os.getpid(),
+                    elapsed=time.perf_counter() - self.start,
+                    timers=dict(self.timers),
+                    counters=dict(self.counters),
+                    peak_rss_mb=self.get_peak_rss())
+
+    def write_report(self, filename, workers=(), **info):
+        # workers: the last statistics of every worker process
+        workers = [dict(stats) for stats in workers]
+        for stats in workers:
+            busy = stats['timers'].get('block', 0.)
+            stats['cells_per_second'] = \
+                stats['counters'].get('cells', 0) / busy if busy else 0.
+
+        # stages of all workers added up
+        worker_timers, worker_counters = {}, {}
+        for stats in workers:
+            for name, value in stats['timers'].items():
+                worker_timers[name] = worker_timers.get(name, 0.) + value
+            for name, value in stats['counters'].items():
+                worker_counters[name] = worker_counters.get(name, 0) + value
+
+        report = dict(info)
+        report.update(self.get_stats())
+        report['worker_timers'] = worker_timers
+        report['worker_counters'] = worker_counters
+        report['workers'] = sorted(workers, key=lambda s: s['pid'])
+
+        with open(filename, 'w') as file:
+            json.dump(report, file, indent=1)
+
+
+# metrics of the current process
+metrics = Metrics()
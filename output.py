@@ -1,52 +1,123 @@
+import os
 import numpy as np
 from netCDF4 import Dataset
 
+from geo import Geo
+from metrics import metrics
+
 
 class Output:
-    def __init__(self, domain, data):
+    def __init__(self, domain, data=None, filename='output.nc'):
+        if data is None:
+            data = [None] * 4
+
         self.sand = data[0]
         self.silt = data[1]
         self.clay = data[2]
         self.cfvo = data[3]
+        # land-use class fractions (classes, rlat, rlon), if any
+        self.fractions = data[4] if len(data) > 4 else None
 
-        self.filename = 'output.nc'
+        self.domain = domain
+        self.filename = filename
         self.rlon_dim = domain.ie_tot
         self.rlat_dim = domain.je_tot
 
+        self.rlon = np.array(domain.rlons)
+        self.rlat = np.array(domain.rlats)
+
+        # the fields have one layer per (depth, statistic), a depth
+        # dimension is only added for depths other than 0-5cm
+        self.layers = domain.get_layers()
+        self.depths = domain.sg_depths
+        self.has_depth = self.depths != ['0-5cm']
+        self.classes = domain.get_classes()
+
+        self.ncfile = None
+
     def write_netcdf(self):
 
-        self.creat_ncfile()
-        self.write_attributes()
-        self.write_data()
+        self.open()
+        self.write_block(0, self.rlat_dim,
+                         self.sand, self.silt, self.clay, self.cfvo,
+                         self.fractions)
+        self.close()
 
-    def creat_ncfile(self):
+    def open(self, block_rows=None):
+        # open the file once, the data is written in row blocks
+        self.creat_ncfile(block_rows)
+        self.write_attributes()
+        self.write_coordinates()
+
+    def get_name(self, var, statistic):
+        # the mean keeps the name of the variable, e.g. sand, sand_Q005
+        if statistic == 'mean':
+            return var
+        return f'{var}_{statistic.replace(".", "")}'
+
+    def get_fraction_name(self, landuse_class):
+        # e.g. landuse_60
+        return f'landuse_{landuse_class}'
+
+    def get_dims(self):
+        if self.has_depth:
+            return ('depth', 'rlat', 'rlon')
+        return ('rlat', 'rlon')
+
+    def close(self):
+        # the output is only in place once it is complete, an interrupted
+        # run leaves the .tmp file and an existing output untouched
+        self.ncfile.close()
+        self.ncfile = None
+        os.replace(f'{self.filename}.tmp', self.filename)
+
+    def creat_ncfile(self, block_rows=None):
         # Create a new NetCDF file
-        ncfile = Dataset(self.filename, 'w', format='NETCDF4')
+        ncfile = Dataset(f'{self.filename}.tmp', 'w', format='NETCDF4')
 
         rlon_dim = self.rlon_dim
         rlat_dim = self.rlat_dim
 
+        # one chunk per row block of the processing
+        if block_rows is None:
+            block_rows = rlat_dim
+        chunks = (min(block_rows, rlat_dim), rlon_dim)
+        options = dict(chunksizes=chunks, zlib=True, complevel=4,
+                       shuffle=True)
+
         # Define dimensions
         ncfile.createDimension('rlon', rlon_dim)
         ncfile.createDimension('rlat', rlat_dim)
+        if self.has_depth:
+            ncfile.createDimension('depth', len(self.depths))
+            ncfile.createDimension('bnds', 2)
 
         # Define variables
-        ncfile.createVariable('lon', np.float32, ('rlat', 'rlon'))
-        ncfile.createVariable('lat', np.float32, ('rlat', 'rlon'))
+        ncfile.createVariable('lon', np.float32, ('rlat', 'rlon'), **options)
+        ncfile.createVariable('lat', np.float32, ('rlat', 'rlon'), **options)
         ncfile.createVariable('rlon', np.float32, ('rlon',))
         ncfile.createVariable('rlat', np.float32, ('rlat',))
         ncfile.createVariable('rotated_pole', 'c')
+        if self.has_depth:
+            ncfile.createVariable('depth', np.float32, ('depth',))
+            ncfile.createVariable('depth_bnds', np.float32, ('depth', 'bnds'))
+            options['chunksizes'] = (1,) + chunks
 
-        ncfile.createVariable('sand', np.float32, ('rlat', 'rlon'))
-        ncfile.createVariable('silt', np.float32, ('rlat', 'rlon'))
-        ncfile.createVariable('clay', np.float32, ('rlat', 'rlon'))
-        ncfile.createVariable('cfvo', np.float32, ('rlat', 'rlon'))
+        for var in ['sand', 'silt', 'clay', 'cfvo']:
+            for statistic in self.domain.sg_stats:
+                ncfile.createVariable(self.get_name(var, statistic),
+                                      np.float32, self.get_dims(), **options)
 
-        ncfile.close()
+        options['chunksizes'] = chunks
+        for landuse_class in self.classes:
+            ncfile.createVariable(self.get_fraction_name(landuse_class),
+                                  np.float32, ('rlat', 'rlon'), **options)
+
+        self.ncfile = ncfile
 
     def write_attributes(self):
 
-        ncfile = Dataset(self.filename, 'a')
+        ncfile = self.ncfile
 
         # Assign attributes to variables
         lon = ncfile.variables['lon']
@@ -54,10 +125,6 @@ class Output:
         rlon = ncfile.variables['rlon']
         rlat = ncfile.variables['rlat']
         rotated_pole = ncfile.variables['rotated_pole']
-        sand = ncfile.variables['sand']
-        silt = ncfile.variables['silt']
-        clay = ncfile.variables['clay']
-        cfvo = ncfile.variables['cfvo']
 
         # Assign attributes
         lon.standard_name = "longitude"
@@ -82,55 +149,89 @@ class Output:
 
         rotated_pole.long_name = "coordinates of the rotated North Pole"
         rotated_pole.grid_mapping_name = "rotated_latitude_longitude"
-        rotated_pole.grid_north_pole_latitude = 80.0
-        rotated_pole.grid_north_pole_longitude = 165.0
-
-        sand.standard_name = "sand"
-        sand.long_name = "sand fraction"
-        sand.units = "-"
-        sand.grid_mapping = "rotated_pole"
-        sand.coordinates = "lat lon"
-
-        silt.standard_name = "silt"
-        silt.long_name = "silt fraction"
-        silt.units = "-"
-        silt.grid_mapping = "rotated_pole"
-        silt.coordinates = "lat lon"
-
-        clay.standard_name = "clay"
-        clay.long_name = "clay fraction"
-        clay.units = "-"
-        clay.grid_mapping = "rotated_pole"
-        clay.coordinates = "lat lon"
-
-        cfvo.standard_name = "cfvo"
-        cfvo.long_name = "cfvo"
-        cfvo.units = "-"
-        cfvo.grid_mapping = "rotated_pole"
-        cfvo.coordinates = "lat lon"
+        rotated_pole.grid_north_pole_latitude = self.domain.pol_lat
+        rotated_pole.grid_north_pole_longitude = self.domain.pol_lon
+
+        if self.has_depth:
+            depth = ncfile.variables['depth']
+            depth.standard_name = "depth"
+            depth.long_name = "depth below surface"
+            depth.units = "cm"
+            depth.positive = "down"
+            depth.axis = "Z"
+            depth.bounds = "depth_bnds"
+
+        long_names = dict(sand="sand fraction", silt="silt fraction",
+                          clay="clay fraction", cfvo="cfvo")
+
+        for var in ['sand', 'silt', 'clay', 'cfvo']:
+            for statistic in self.domain.sg_stats:
+                field = ncfile.variables[self.get_name(var, statistic)]
+
+                field.standard_name = var
+                field.long_name = long_names[var]
+                if statistic != 'mean':
+                    field.long_name += f" {statistic}"
+                field.units = "-"
+                field.grid_mapping = "rotated_pole"
+                field.coordinates = "lat lon"
+
+        for landuse_class in self.classes:
+            field = ncfile.variables[self.get_fraction_name(landuse_class)]
+            field.long_name = f"fraction of land-use class {landuse_class}"
+            field.units = "-"
+            field.grid_mapping = "rotated_pole"
+            field.coordinates = "lat lon"
+
+        if self.classes:
+            ncfile.landuse = self.domain.landuse
 
         # Assign global attributes
-        ncfile.pollon = 165.0
-        ncfile.pollat = 80.0
-
-        # Close the file
-        ncfile.close()
-
-    def write_data(self):
-        ncfile = Dataset(self.filename, 'a')
-
-        print(self.sand.shape)
-
-        # Write data to variables
-        # ncfile.variables['lon'][:, :] = lon_data
-        # ncfile.variables['lat'][:, :] = lat_data
-        # ncfile.variables['rlon'][:] = rlon_data
-        # ncfile.variables['rlat'][:] = rlat_data
-
-        ncfile.variables['sand'][:, :] = self.sand
-        ncfile.variables['silt'][:, :] = self.silt
-        ncfile.variables['clay'][:, :] = self.clay
-        ncfile.variables['cfvo'][:, :] = self.cfvo
-
-        # Close the file
-        ncfile.close()
+        ncfile.pollon = self.domain.pol_lon
+        ncfile.pollat = self.domain.pol_lat
+
+    def write_coordinates(self):
+        self.ncfile.variables['rlon'][:] = self.rlon
+        self.ncfile.variables['rlat'][:] = self.rlat
+
+        if self.has_depth:
+            # e.g. 15-30cm
+            bounds = np.array([depth[:-2].split('-')
+                               for depth in self.depths], dtype=float)
+            self.ncfile.variables['depth'][:] = bounds.mean(axis=1)
+            self.ncfile.variables['depth_bnds'][:] = bounds
+
+    def write_part(self, i0, i1, j0, j1, filename):
+        # copy all fields of the output of a part of the domain, e.g. a
+        # tile of Partition, into the box j0:j1, i0:i1
+        with Dataset(filename) as part:
+            for name, field in self.ncfile.variables.items():
+                if field.dimensions[-2:] == ('rlat', 'rlon'):
+                    field[..., j0:j1, i0:i1] = part.variables[name][:]
+
+    def write_block(self, j0, j1, sand, silt, clay, cfvo, fractions=None):
+        with metrics.timer('write'):
+            ncfile = self.ncfile
+
+            # geographical coordinates of the rows of the block
+            rlon, rlat = np.meshgrid(self.rlon, self.rlat[j0:j1])
+            lon, lat = Geo(self.domain).rot2geo(rlon, rlat)
+
+            # Write data to variables
+            ncfile.variables['lon'][j0:j1, :] = lon
+            ncfile.variables['lat'][j0:j1, :] = lat
+
+            # one layer per (depth, statistic) along the first axis
+            for var, data in zip(['sand', 'silt', 'clay', 'cfvo'],
+                                 [sand, silt, clay, cfvo]):
+                for k, (depth, statistic) in enumerate(self.layers):
+                    field = ncfile.variables[self.get_name(var, statistic)]
+                    if self.has_depth:
+                        field[self.depths.index(depth), j0:j1, :] = data[k]
+                    else:
+                        field[j0:j1, :] = data[k]
+
+            # one fraction per land-use class along the first axis
+            for k, landuse_class in enumerate(self.classes):
+                field = ncfile.variables[self.get_fraction_name(landuse_class)]
+                field[j0:j1, :] = fractions[k]
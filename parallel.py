@@ -1,74 +1,477 @@
-from itertools import product
+import cProfile
+import copy
 import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
 import numpy as np
 
+from metrics import metrics
 from soilgrids import Soilgrids
-from domain import Domain
 from geo import Geo
 
 
+# state of each worker process, filled once in the first task; shared by
+# all threads with the thread backend
+worker_state = {}
+
+
+def init_worker(domain, footprint, names=None, todo=None, step=None):
+    # the metrics of the main process are copied into forked workers
+    metrics.reset()
+
+    if domain.cprofile is not None:
+        worker_state['profile'] = cProfile.Profile()
+        worker_state['profile'].enable()
+
+    # the rasters are loaded in the first task, see load_pending
+    worker_state['load'] = (domain, footprint, names, step)
+    # grid boxes to compute, the others are known from the cell cache
+    worker_state['todo'] = todo
+
+
+def load_pending(state, load):
+    # load(*state['load']) once, in the first task of a worker: an error
+    # in the pool initializer ends the worker, the pool starts a new one
+    # with the same error and the run hangs, an error in a task is raised
+    # in the main process
+    if 'load' not in state:
+        return
+
+    try:
+        load(*state['load'])
+    except SystemExit:
+        # exit() would also end the worker without an answer
+        raise RuntimeError('loading the rasters failed, see above') from None
+    del state['load']
+
+
+def load_state(domain, footprint, names=None, step=None):
+    # load everything that does not depend on the grid box once per process;
+    # step: processing step of the files chosen by the main process, so
+    # all processes read the same files
+    with metrics.timer('init'):
+        soilgrids = Soilgrids.from_domain(domain, step=step)
+        soilgrids.open()
+        # at 250m only the footprint of the current row block is read, with
+        # memory maps the boxes are read from the shared pages instead
+        if footprint and domain.sg_res != 'fine' and not domain.sg_memmap:
+            soilgrids.read_footprint(domain)
+
+    worker_state['domain'] = domain
+    worker_state['soilgrids'] = soilgrids
+    worker_state['geo'] = Geo(domain)
+    worker_state['footprint'] = footprint
+
+    if names is not None:
+        worker_state['results'] = SharedResults(domain, names)
+
+
+class SharedResults:
+    # float32 result fields (sand, silt, clay, cfvo) of all layers, the
+    # land-use class fractions and the valid mask of the whole domain in
+    # shared memory, written directly by the workers
+    def __init__(self, domain, names=None):
+        shape = (domain.je_tot, domain.ie_tot)
+        size = domain.je_tot * domain.ie_tot
+        nlayers = len(domain.get_layers())
+        nclasses = len(domain.get_classes())
+
+        if names is None:
+            self.data_shm = shared_memory.SharedMemory(
+                create=True,
+                size=4 * nlayers * size * np.dtype(np.float32).itemsize)
+            self.valid_shm = shared_memory.SharedMemory(
+                create=True, size=size)
+            # shared memory can not be empty
+            self.fractions_shm = shared_memory.SharedMemory(
+                create=True,
+                size=max(nclasses * size * np.dtype(np.float32).itemsize, 1))
+        else:
+            self.data_shm = shared_memory.SharedMemory(name=names[0])
+            self.valid_shm = shared_memory.SharedMemory(name=names[1])
+            self.fractions_shm = shared_memory.SharedMemory(name=names[2])
+
+        self.data = np.ndarray((4, nlayers) + shape, dtype=np.float32,
+                               buffer=self.data_shm.buf)
+        self.valid = np.ndarray(shape, dtype=bool, buffer=self.valid_shm.buf)
+        self.fractions = np.ndarray((nclasses,) + shape, dtype=np.float32,
+                                    buffer=self.fractions_shm.buf)
+
+        if names is None:
+            self.data[:] = np.nan
+            self.valid[:] = False
+            self.fractions[:] = np.nan
+
+    def get_names(self):
+        return self.data_shm.name, self.valid_shm.name, self.fractions_shm.name
+
+    def close(self):
+        # the arrays have to be released before the memory is closed
+        self.data = None
+        self.valid = None
+        self.fractions = None
+        self.data_shm.close()
+        self.valid_shm.close()
+        self.fractions_shm.close()
+        self.data_shm.unlink()
+        self.valid_shm.unlink()
+        self.fractions_shm.unlink()
+
+
 class Parallel:
     def __init__(self):
         self.interpolated_data = []
+        self.valid = None
+        # last metrics of each worker process
+        self.workers = {}
+
+    def get_blocks(self, domain, block_rows):
+        # split the domain into blocks of rlat rows
+        return [(j, min(j + block_rows, domain.je_tot))
+                for j in range(0, domain.je_tot, block_rows)]
 
-    def processing(self, domain, max_processes):
-        rlonlatlist = list(product(domain.rlons, domain.rlats))
+    def processing(self, domain, max_processes, block_rows=8,
+                   footprint=True, output=None, checkpoint=None,
+                   backend='process', cache=None, step=None):
+        # with an opened Output, each row block is written as soon as it
+        # is finished and the fields of the whole domain are not kept;
+        # with a Checkpoint, finished blocks are saved and the blocks of
+        # an earlier run are taken from it instead of computed again;
+        # backend: 'process' for a pool of processes, 'thread' for
+        # threads in this process that share one copy of the rasters;
+        # with a CellCache only the grid boxes not known from earlier runs
+        # are computed; step: processing step of the files, see Soilgrids
+        blocks = self.get_blocks(domain, block_rows)
 
-        # Create a multiprocessing pool
-        with multiprocessing.Pool(processes=max_processes) as pool:
-            # Map the function to the coordinates using multiple processes
+        results = SharedResults(domain)
+        soilgrids = Soilgrids()
+        soilgrids.layers = domain.get_layers()
+
+        try:
+            if checkpoint is not None:
+                blocks = self.restore_blocks(blocks, block_rows, results,
+                                             soilgrids, output, checkpoint)
+            todo = None
+            if cache is not None:
+                blocks, todo = self.restore_cells(blocks, results, soilgrids,
+                                                  output, checkpoint, cache)
 
-            results = pool.starmap(self.get, rlonlatlist)
+            # Create a multiprocessing pool, each worker loads the domain,
+            # the soilgrids files and the geo object once and writes its
+            # results to the shared memory
+            if blocks and backend == 'thread':
+                self.run_threads(domain, max_processes, blocks, footprint,
+                                 results, soilgrids, output, checkpoint,
+                                 todo, step=step)
+            elif blocks:
+                self.run_blocks(domain, max_processes, blocks, footprint,
+                                results, soilgrids, output, checkpoint, todo,
+                                step)
 
-        sand, silt, clay, cfvo = [], [], [], []
+            if cache is not None:
+                with metrics.timer('cell cache'):
+                    cache.save(results.data, results.fractions)
 
-        for res in results:
-            sand.append(res[0])
-            silt.append(res[1])
-            clay.append(res[2])
-            cfvo.append(res[3])
+            if output is None:
+                sand, silt, clay, cfvo = results.data.copy()
+                fractions = results.fractions.copy()
+            self.valid = results.valid.copy()
+        finally:
+            results.close()
 
-        sand = np.array(sand).reshape(
-            (domain.je_tot, domain.ie_tot), order='F')
-        silt = np.array(silt).reshape(
-            (domain.je_tot, domain.ie_tot), order='F')
-        clay = np.array(clay).reshape(
-            (domain.je_tot, domain.ie_tot), order='F')
-        cfvo = np.array(cfvo).reshape(
-            (domain.je_tot, domain.ie_tot), order='F')
+        if output is not None:
+            return
+
+        # normalize sand, silt and clay of all grid boxes at once
+        with metrics.timer('gather'):
+            sand, silt, clay = soilgrids.norm_layers(sand, silt, clay)
 
         self.interpolated_data.append(sand)
         self.interpolated_data.append(silt)
         self.interpolated_data.append(clay)
         self.interpolated_data.append(cfvo)
+        if domain.landuse is not None:
+            self.interpolated_data.append(fractions)
 
-    def get(self, rlon, rlat):
-        domain = Domain()
-        domain.read_domain_file()
-        soilgrids = Soilgrids()
-        soilgrids.initialize(domain.sg_res)
-        geo = Geo(domain)
+    def restore_blocks(self, blocks, block_rows, results, soilgrids, output,
+                       checkpoint):
+        # the blocks of an earlier run from the checkpoint, returns the
+        # blocks that are still to do
+        checkpoint.open(block_rows)
+        done = checkpoint.get_done(blocks)
+        if done:
+            print(f'{len(done)} of {len(blocks)} row blocks from '
+                  f'{checkpoint.path}')
+        for j0, j1 in done:
+            data, valid, fractions = checkpoint.load(j0, j1)
+            results.data[:, :, j0:j1, :] = data
+            results.valid[j0:j1, :] = valid
+            results.fractions[:, j0:j1, :] = fractions
+            self.finish_block(j0, j1, results, soilgrids, output)
+
+        return [block for block in blocks if block not in done]
+
+    def restore_cells(self, blocks, results, soilgrids, output, checkpoint,
+                      cache):
+        # the grid boxes of earlier runs from the cell cache, blocks without
+        # new grid boxes are finished; returns the blocks that are still to
+        # do and the mask of the grid boxes to compute
+        todo = cache.load(results.data, results.fractions)
+        results.valid[~todo] = np.isfinite(results.data[0, 0][~todo])
+
+        known = todo.size - np.count_nonzero(todo)
+        if known:
+            print(f'{known} of {todo.size} grid boxes from {cache.filename}')
+
+        remaining = []
+        for j0, j1 in blocks:
+            if todo[j0:j1].any():
+                remaining.append((j0, j1))
+            else:
+                self.finish_block(j0, j1, results, soilgrids, output,
+                                  checkpoint)
+
+        return remaining, todo
+
+    def run_blocks(self, domain, max_processes, blocks, footprint, results,
+                   soilgrids, output, checkpoint, todo=None, step=None):
+        with multiprocessing.Pool(
+                processes=max_processes, initializer=init_worker,
+                initargs=(domain, footprint, results.get_names(),
+                          todo, step)) as pool:
+            for (j0, j1), stats in pool.imap_unordered(self.get_block,
+                                                       blocks):
+                self.workers[stats['pid']] = stats
+                self.finish_block(j0, j1, results, soilgrids, output,
+                                  checkpoint)
+
+    def run_threads(self, domain, max_processes, blocks, footprint, results,
+                    soilgrids, output, checkpoint, todo=None, prefetch=2,
+                    step=None):
+        # the rasters are loaded once; prefetch reader threads read the
+        # raster data of the next row blocks while max_processes compute
+        # threads mask and average the blocks already read. At most
+        # prefetch blocks are read but not computed, so at most
+        # prefetch + max_processes footprints are in memory.
+        load_state(domain, footprint, step=step)
+        worker_state['results'] = results
+        worker_state['todo'] = todo
+
+        blocks = deque(blocks)
+        reading = deque()
+        computing = set()
+
+        try:
+            with ThreadPoolExecutor(max_workers=prefetch) as readers, \
+                    ThreadPoolExecutor(max_workers=max_processes) as workers:
+                while blocks or reading or computing:
+                    # keep prefetch row blocks read ahead of the compute,
+                    # a block moves on as soon as a compute thread is free
+                    while True:
+                        while blocks and len(reading) < prefetch:
+                            block = blocks.popleft()
+                            reading.append((block, readers.submit(
+                                self.read_block, block)))
+
+                        if not reading or len(computing) >= max_processes:
+                            break
+                        block, future = reading.popleft()
+                        computing.add(workers.submit(
+                            self.compute_block, block, future.result()))
+
+                    finished, computing = wait(computing,
+                                               return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        j0, j1 = future.result()
+                        self.finish_block(j0, j1, results, soilgrids,
+                                          output, checkpoint)
+        finally:
+            worker_state.clear()
+
+    def finish_block(self, j0, j1, results, soilgrids, output,
+                     checkpoint=None):
+        if checkpoint is not None:
+            with metrics.timer('checkpoint'):
+                checkpoint.save(j0, j1, results.data[:, :, j0:j1, :],
+                                results.valid[j0:j1, :],
+                                results.fractions[:, j0:j1, :])
+
+        if output is None:
+            return
+
+        with metrics.timer('gather'):
+            sand, silt, clay, cfvo = results.data[:, :, j0:j1, :]
+            # normalize sand, silt and clay of the block
+            sand, silt, clay = soilgrids.norm_layers(sand, silt, clay)
+        output.write_block(j0, j1, sand, silt, clay, cfvo,
+                           results.fractions[:, j0:j1, :])
+
+    def get_block(self, block):
+        load_pending(worker_state, load_state)
+        with metrics.timer('block'):
+            self.compute_block(block, self.read_block(block))
+
+        self.dump_profile()
+
+        return block, metrics.get_stats()
+
+    def read_block(self, block):
+        # soilgrids with the raster data of the row block; at 250m the
+        # footprint of the block is read into a copy, so that blocks can
+        # be read while others are computed
+        domain = worker_state['domain']
+        soilgrids = worker_state['soilgrids']
+        j0, j1 = block
+
+        if worker_state['footprint'] and domain.sg_res == 'fine':
+            soilgrids = copy.copy(soilgrids)
+            soilgrids.read_footprint(domain, j0, j1)
+
+        return soilgrids
+
+    def compute_block(self, block, soilgrids):
+        domain = worker_state['domain']
+        results = worker_state['results']
+        todo = worker_state.get('todo')
+        j0, j1 = block
+
+        cells = 0
+        for j in range(j0, j1):
+            for i in range(domain.ie_tot):
+                if todo is not None and not todo[j, i]:
+                    continue
+                cells += 1
+                *res, fractions = self.get(domain.rlons[i], domain.rlats[j],
+                                           soilgrids)
+                results.data[:, :, j, i] = [np.ma.filled(mean, np.nan)
+                                            for mean in res]
+                if fractions is not None:
+                    results.fractions[:, j, i] = fractions
+                results.valid[j, i] = np.isfinite(results.data[0, 0, j, i])
+
+        metrics.count('blocks')
+        metrics.count('cells', cells)
+
+        return block
+
+    def dump_profile(self):
+        # cumulative cProfile statistics of the worker, one file per process
+        profile = worker_state.get('profile')
+        if profile is None:
+            return
+
+        profile.dump_stats(f"{worker_state['domain'].cprofile}.{os.getpid()}")
+        profile.enable()
+
+    def weights(self, domain, max_processes, block_rows=1, step=None):
+        # weights of the pixels of the domain footprint in each grid box
+        blocks = self.get_blocks(domain, block_rows)
+
+        rows, cols, vals = [], [], []
+
+        with multiprocessing.Pool(processes=max_processes,
+                                  initializer=init_worker,
+                                  initargs=(domain, True, None, None,
+                                            step)) as pool:
+            for res in pool.imap_unordered(self.get_weights_block, blocks):
+                rows.append(res[0])
+                cols.append(res[1])
+                vals.append(res[2])
+                self.workers[res[3]['pid']] = res[3]
+
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+
+    def get_weights_block(self, block):
+        load_pending(worker_state, load_state)
+        domain = worker_state['domain']
+        soilgrids = worker_state['soilgrids']
+        geo = worker_state['geo']
+        j0, j1 = block
+
+        # the weights index the pixels of the footprint of the whole
+        # domain, which load_state does not read with memory maps
+        if soilgrids.footprint is None:
+            soilgrids.read_footprint(domain)
+
+        footprint = soilgrids.footprint
+        width = soilgrids.sanddata[0].shape[-1]
+
+        rows, cols, vals = [], [], []
+
+        with metrics.timer('block'):
+            for j in range(j0, j1):
+                for i in range(domain.ie_tot):
+                    with metrics.timer('masking'):
+                        corner_x, corner_y = geo.get_corners(
+                            domain.rlons[i], domain.rlats[j])
+                        box, int_box, lon, lat = soilgrids.get_window(
+                            corner_x, corner_y)
+
+                        polygon_vertices = np.array(
+                            list(zip(corner_x, corner_y)))
+                        weights = geo.get_weights(lon, lat, polygon_vertices)
+
+                    # flat index of the pixels in the footprint array
+                    jj, ii = np.nonzero(weights > 0)
+                    vals.append(weights[jj, ii])
+                    jj += int_box[0][1] - footprint[0][1]
+                    ii += int_box[0][0] - footprint[0][0]
+
+                    rows.append(np.full(len(ii), j * domain.ie_tot + i))
+                    cols.append(jj * width + ii)
+
+        metrics.count('blocks')
+        metrics.count('cells', (j1 - j0) * domain.ie_tot)
+        self.dump_profile()
+
+        return (np.concatenate(rows), np.concatenate(cols),
+                np.concatenate(vals), metrics.get_stats())
+
+    def get(self, rlon, rlat, soilgrids=None):
+        domain = worker_state['domain']
+        if soilgrids is None:
+            soilgrids = worker_state['soilgrids']
+        geo = worker_state['geo']
 
         # print(rlon, rlat)
 
         corner_x, corner_y = geo.get_corners(rlon, rlat)
-        sand, silt, clay, cfvo, lon, lat = soilgrids.read(corner_x, corner_y)
+        sand, silt, clay, cfvo, lon, lat, landuse = soilgrids.read(corner_x,
+                                                                   corner_y)
 
-        polygon_vertices = np.array(list(zip(corner_x, corner_y)))
-        mask = geo.mask_with_polygon(lon, lat, polygon_vertices)
-        # sand = np.where(mask, sand, np.nan)
-        data_mask = sand.mask | mask
+        with metrics.timer('masking'):
+            polygon_vertices = np.array(list(zip(corner_x, corner_y)))
+            weights = geo.get_weights(lon, lat, polygon_vertices)
+            # sand = np.where(mask, sand, np.nan)
+            # the geometry is the same for all layers, the sand mask per
+            # layer
+            data_mask = np.ma.getmaskarray(sand) | (weights <= 0)
+            # with land use, the fractions are taken from the same window
+            # and each pixel counts with the part covered by the classes
+            fractions = None
+            if landuse is not None:
+                fractions = soilgrids.class_fractions(landuse, weights)
+                cover = np.sum(landuse, axis=0)
+                data_mask |= cover <= 0
+            if domain.weighting == 'mask':
+                weights = None
+            if landuse is not None:
+                weights = cover if weights is None else weights * cover
 
-        sand = np.ma.array(sand, mask=data_mask)
-        silt = np.ma.array(silt, mask=data_mask)
-        clay = np.ma.array(clay, mask=data_mask)
-        cfvo = np.ma.array(cfvo, mask=data_mask)
+            sand = np.ma.array(sand, mask=data_mask)
+            silt = np.ma.array(silt, mask=data_mask)
+            clay = np.ma.array(clay, mask=data_mask)
+            cfvo = np.ma.array(cfvo, mask=data_mask)
 
-        mean_sand, mean_silt, mean_clay = soilgrids.norm_box_mean(
-            sand, silt, clay)
-        mean_cfvo = soilgrids.box_mean(cfvo)
+        with metrics.timer('averaging'):
+            mean_sand = soilgrids.box_mean(sand, weights)
+            mean_silt = soilgrids.box_mean(silt, weights)
+            mean_clay = soilgrids.box_mean(clay, weights)
+            mean_cfvo = soilgrids.box_mean(cfvo, weights)
 
-        return mean_sand, mean_silt, mean_clay, mean_cfvo
+        return mean_sand, mean_silt, mean_clay, mean_cfvo, fractions
 
     def get_data(self):
         return self.interpolated_data
@@ -0,0 +1,105 @@
+import copy
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from helper import Helper
+from output import Output
+
+
+class Partition:
+    """
+    Split of a domain into tiles_x x tiles_y rectangular tiles.
+
+    Every tile is an ordinary domain with its own start and size, and can
+    be processed as an independent job (e.g. on another node) writing
+    its own output. merge puts the tile outputs together into the output
+    of the whole domain.
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.tiles_x, self.tiles_y = domain.tiles
+
+    def get_tiles(self):
+        # (i0, i1, j0, j1) of each tile, numbered row by row
+        cols = np.linspace(0, self.domain.ie_tot, self.tiles_x + 1)
+        rows = np.linspace(0, self.domain.je_tot, self.tiles_y + 1)
+        cols = np.round(cols).astype(int)
+        rows = np.round(rows).astype(int)
+
+        return [(int(cols[i]), int(cols[i+1]), int(rows[j]), int(rows[j+1]))
+                for j in range(self.tiles_y) for i in range(self.tiles_x)]
+
+    def get_filename(self, filename, k):
+        # output.nc -> output.tile3.nc
+        root, ext = os.path.splitext(filename)
+        return f'{root}.tile{k}{ext}'
+
+    def get_subdomain(self, k):
+        tiles = self.get_tiles()
+        if not 0 <= k < len(tiles):
+            print(f'tile must be between 0 and {len(tiles) - 1}; exit')
+            exit()
+
+        i0, i1, j0, j1 = tiles[k]
+        domain = self.domain
+
+        subdomain = copy.copy(domain)
+        subdomain.name = f'{domain.name}_tile{k}'
+        subdomain.startlon = domain.startlon + i0 * domain.dx
+        subdomain.startlat = domain.startlat + j0 * domain.dx
+        subdomain.ie_tot = i1 - i0
+        subdomain.je_tot = j1 - j0
+        subdomain.tiles = (1, 1)
+        subdomain.output = self.get_filename(domain.output, k)
+        if domain.report is not None:
+            subdomain.report = self.get_filename(domain.report, k)
+        if domain.cprofile is not None:
+            subdomain.cprofile = f'{domain.cprofile}.tile{k}'
+
+        # the same rotated coordinates as in the whole domain
+        subdomain.rlons = domain.rlons[i0:i1]
+        subdomain.rlats = domain.rlats[j0:j1]
+
+        return subdomain
+
+    def run_local(self, dfilename, jobs=None, options=()):
+        # all tile jobs as separate processes on this machine, then merge;
+        # options: command line options passed on to the tile jobs
+        tiles = self.get_tiles()
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'soil_init.py')
+
+        def run(k):
+            return subprocess.run([sys.executable, script, dfilename, 'tile',
+                                   str(k)] + list(options)).returncode
+
+        with ThreadPoolExecutor(max_workers=jobs or len(tiles)) as executor:
+            failed = [k for k, code in enumerate(executor.map(
+                run, range(len(tiles)))) if code != 0]
+
+        if failed:
+            print(f'ERROR: tiles {failed} failed; exit')
+            exit()
+
+        self.merge()
+
+    def merge(self):
+        # the output of the whole domain from the outputs of all tiles
+        tiles = self.get_tiles()
+        filenames = [self.get_filename(self.domain.output, k)
+                     for k in range(len(tiles))]
+
+        missing = [f for f in filenames if not Helper().check_file(f)]
+        if missing:
+            print(f'ERROR: missing tile outputs {missing}; exit')
+            exit()
+
+        output = Output(self.domain, filename=self.domain.output)
+        output.open(max(j1 - j0 for i0, i1, j0, j1 in tiles))
+        for (i0, i1, j0, j1), filename in zip(tiles, filenames):
+            output.write_part(i0, i1, j0, j1, filename)
+        output.close()
@@ -0,0 +1,92 @@
+import hashlib
+import numpy as np
+from scipy import sparse
+
+from helper import Helper
+
+
+class Remap:
+    def __init__(self, domain, soilgrids):
+        self.domain = domain
+        self.soilgrids = soilgrids
+
+        self.matrix = None
+        self.cachefile = None
+
+    def get_key(self):
+        # the weights depend only on the grid geometry and the resolution
+        domain = self.domain
+        geometry = (domain.dx, domain.pol_lon, domain.pol_lat,
+                    domain.ie_tot, domain.je_tot,
+                    domain.startlat, domain.startlon, domain.sg_res,
+                    domain.weighting)
+
+        return hashlib.sha256(repr(geometry).encode()).hexdigest()[:16]
+
+    def initialize(self, parallel, max_processes):
+        resolution = self.domain.sg_res
+        cachedir = f'{self.soilgrids.store.root}/{resolution}/remap'
+
+        Helper().make_dir(cachedir)
+        self.cachefile = f'{cachedir}/{self.get_key()}.npz'
+
+        self.soilgrids.read_footprint(self.domain)
+
+        if not self.load():
+            rows, cols, vals = parallel.weights(self.domain, max_processes,
+                                                step=self.soilgrids.step)
+            self.build(rows, cols, vals)
+            self.save(rows, cols, vals)
+
+    def build(self, rows, cols, vals):
+        ncells = self.domain.ie_tot * self.domain.je_tot
+        npixels = self.soilgrids.sanddata[0].size
+
+        self.matrix = sparse.csr_matrix(
+            (vals, (rows, cols)), shape=(ncells, npixels))
+
+    def load(self):
+        if not Helper().check_file(self.cachefile):
+            return False
+
+        cache = np.load(self.cachefile)
+
+        # the pixel indices are only valid for the same footprint
+        if not np.array_equal(cache['footprint'], self.soilgrids.footprint):
+            return False
+
+        self.build(cache['rows'], cache['cols'], cache['vals'])
+        return True
+
+    def save(self, rows, cols, vals):
+        np.savez_compressed(self.cachefile, rows=rows, cols=cols, vals=vals,
+                            footprint=np.array(self.soilgrids.footprint))
+
+    def box_mean(self, data, valid):
+        # weighted mean of the valid pixels in each grid box, all layers
+        # (pixels, layers) in one product
+        weight = self.matrix @ valid
+        total = self.matrix @ np.where(valid, data, 0.)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(weight > 0, total / weight, np.nan)
+
+        return mean.T.reshape((-1, self.domain.je_tot, self.domain.ie_tot))
+
+    def interpolate(self):
+        soilgrids = self.soilgrids
+        nlayers = len(soilgrids.layers)
+
+        # all variables are masked with the sand mask, as in Parallel.get
+        valid = ~np.ma.getmaskarray(soilgrids.get_values(
+            soilgrids.sanddata)).reshape((nlayers, -1)).T
+
+        sand, silt, clay, cfvo = [
+            self.box_mean(soilgrids.get_values(data).data.reshape(
+                (nlayers, -1)).T, valid)
+            for data in [soilgrids.sanddata, soilgrids.siltdata,
+                         soilgrids.claydata, soilgrids.cfvodata]]
+
+        sand, silt, clay = soilgrids.norm_layers(sand, silt, clay)
+
+        return [sand, silt, clay, cfvo.astype(np.float32)]
@@ -0,0 +1,306 @@
+"""
+Regridding service with the SoilGrids rasters kept in memory.
+
+    python service.py --port 8765 --workers 4 --preload my.domain
+
+The service listens on localhost. Each worker process of a bounded pool
+keeps the rasters of recent settings and the footprints of recent domains,
+so only the first request with new settings pays for imports,
+initialization and reading. The rows of a domain are spread over the
+pool; concurrent requests share it.
+
+    POST /regrid   JSON object with the settings of a domain file
+                   ("name", "dx", "pol_lon", ...). Answers with the
+                   fields, or with {"output": path} if the object has an
+                   "output" entry and the NetCDF file was written there.
+    GET  /health   {"status": "ok"}
+
+request() is a small client, e.g. for tests on localhost.
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import threading
+import types
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from batch import get_raster_key
+from domain import Domain
+from geo import Geo
+from output import Output
+from parallel import Parallel, worker_state
+from soilgrids import Soilgrids
+
+
+# opened Soilgrids objects of a worker process by raster settings, the
+# last ones requested
+resident = {}
+
+# Soilgrids with the footprint of recent domains, by domain settings
+footprints = {}
+
+# settings that have a default in Domain
+REQUIRED = ['name', 'dx', 'pol_lon', 'pol_lat', 'ie_tot', 'je_tot',
+            'startlat', 'startlon', 'sg_res']
+
+# the checks of Domain print the reason and exit, one request at a time
+# is checked with the output captured
+check_lock = threading.Lock()
+
+
+def get_domain(settings):
+    # a Domain from the settings of a request
+    settings = dict(settings)
+    for name in ['dx_coarse', 'start_date', 'end_date']:
+        settings.setdefault(name, None)
+
+    domain = Domain()
+    domain.read_settings(types.SimpleNamespace(**settings))
+    domain.get_rlons_rlats()
+
+    return domain
+
+
+def check_domain(settings):
+    # the reason why the settings are not a valid domain, None if they are
+    missing = [name for name in REQUIRED if name not in settings]
+    if missing:
+        return f'missing settings {missing}'
+
+    output = io.StringIO()
+    with check_lock, contextlib.redirect_stdout(output):
+        try:
+            get_domain(settings)
+        except SystemExit:
+            return output.getvalue().strip() or 'invalid settings'
+        except (ValueError, TypeError) as error:
+            return str(error)
+
+    return None
+
+
+def get_soilgrids(domain, size=8):
+    # rasters of the domain, opened once per worker process; the land use
+    # is only on the pixel grid over the footprint of the domain, so each
+    # moved land-use domain has its own entry and only the last size
+    # entries are kept
+    key = get_raster_key(domain)
+    if domain.landuse is not None:
+        key += tuple(domain.get_box())
+    if key not in resident:
+        soilgrids = Soilgrids.from_domain(domain)
+        if domain.reproject != 'direct':
+            soilgrids.open()
+        while len(resident) >= size:
+            resident.pop(next(iter(resident)))
+        resident[key] = soilgrids
+
+    return resident[key]
+
+
+def init_worker(preload):
+    for settings in preload:
+        get_soilgrids(get_domain(settings))
+
+
+def get_footprint(settings, domain, size=8):
+    # Soilgrids with the footprint of the domain, the footprints of the
+    # last size domains are kept, e.g. while a domain is edited
+    key = json.dumps({name: value for name, value in settings.items()
+                      if name != 'output'}, sort_keys=True)
+
+    if key not in footprints:
+        soilgrids = copy.copy(get_soilgrids(domain))
+        if domain.sg_res != 'fine' and not domain.sg_memmap:
+            soilgrids.read_footprint(domain)
+        while len(footprints) >= size:
+            footprints.pop(next(iter(footprints)))
+        footprints[key] = soilgrids
+
+    return footprints[key]
+
+
+def regrid_block(settings, j0, j1):
+    # mean values and land-use fractions of the rows j0:j1 of a domain in
+    # a worker process
+    domain = get_domain(settings)
+    soilgrids = get_footprint(settings, domain)
+
+    nlayers = len(domain.get_layers())
+    nclasses = len(domain.get_classes())
+    results = types.SimpleNamespace(
+        data=np.full((4, nlayers, domain.je_tot, domain.ie_tot), np.nan,
+                     dtype=np.float32),
+        valid=np.zeros((domain.je_tot, domain.ie_tot), dtype=bool),
+        fractions=np.full((nclasses, domain.je_tot, domain.ie_tot), np.nan,
+                          dtype=np.float32))
+
+    worker_state.update(domain=domain, soilgrids=soilgrids,
+                        geo=Geo(domain), footprint=True, results=results)
+    parallel = Parallel()
+    parallel.compute_block((j0, j1), parallel.read_block((j0, j1)))
+
+    return results.data[:, :, j0:j1, :], results.fractions[:, j0:j1, :]
+
+
+def regrid_direct(settings):
+    domain = get_domain(settings)
+    return get_soilgrids(domain).reproject_to_domain(domain)
+
+
+def regrid_sample(settings):
+    # quick-look fields, the footprint rows are read into a copy of the
+    # resident rasters
+    domain = get_domain(settings)
+    soilgrids = copy.copy(get_soilgrids(domain))
+    return soilgrids.sample(domain, domain.interpolation)
+
+
+def regrid(pool, settings, workers):
+    # sand, silt, clay and cfvo of a domain, the row blocks are spread
+    # over the pool, a quick-look interpolation is done by one worker;
+    # remap is not used, its weights need a pool of their own
+    domain = get_domain(settings)
+
+    if domain.reproject == 'direct':
+        data = pool.submit(regrid_direct, settings).result()
+    elif domain.interpolation != 'box':
+        data = pool.submit(regrid_sample, settings).result()
+    else:
+        rows = int(np.ceil(domain.je_tot / workers))
+        blocks = [(j, min(j + rows, domain.je_tot))
+                  for j in range(0, domain.je_tot, rows)]
+        futures = [pool.submit(regrid_block, settings, j0, j1)
+                   for j0, j1 in blocks]
+        parts = [future.result() for future in futures]
+        sand, silt, clay, cfvo = np.concatenate(
+            [part for part, fractions in parts], axis=2)
+        fractions = np.concatenate(
+            [fractions for part, fractions in parts], axis=1)
+
+        soilgrids = Soilgrids()
+        soilgrids.layers = domain.get_layers()
+        sand, silt, clay = soilgrids.norm_layers(sand, silt, clay)
+        data = [sand, silt, clay, cfvo, fractions]
+
+    output = Output(domain, data, domain.output)
+    if 'output' in settings:
+        output.write_netcdf()
+        return dict(output=domain.output)
+
+    lon, lat = Geo(domain).rot2geo(*np.meshgrid(domain.rlons, domain.rlats))
+    fields = dict(rlon=domain.rlons, rlat=domain.rlats,
+                  lon=lon.tolist(), lat=lat.tolist(),
+                  layers=domain.get_layers())
+    for var, field in zip(['sand', 'silt', 'clay', 'cfvo'], data):
+        fields[var] = to_list(field)
+    for k, landuse_class in enumerate(domain.get_classes()):
+        fields[output.get_fraction_name(landuse_class)] = to_list(data[4][k])
+
+    return fields
+
+
+def to_list(field):
+    # NaN is not valid JSON
+    field = np.asarray(field, dtype=float).astype(object)
+    field[np.isnan(field.astype(float))] = None
+    return field.tolist()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # the pool and its size are set by serve
+    pool = None
+    workers = 1
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, dict(status='ok'))
+        else:
+            self.send_json(404, dict(error='unknown path'))
+
+    def do_POST(self):
+        if self.path != '/regrid':
+            self.send_json(404, dict(error='unknown path'))
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            settings = json.loads(self.rfile.read(length))
+        except ValueError as error:
+            self.send_json(400, dict(error=f'invalid JSON: {error}'))
+            return
+
+        # the settings are checked before a worker is used
+        reason = check_domain(settings) if isinstance(settings, dict) \
+            else 'the settings must be a JSON object'
+        if reason is not None:
+            self.send_json(400, dict(error=f'invalid domain: {reason}'))
+            return
+
+        try:
+            self.send_json(200, regrid(self.pool, settings, self.workers))
+        except BaseException as error:
+            self.send_json(500, dict(error=repr(error)))
+
+
+def serve(host='127.0.0.1', port=8765, workers=4, preload=()):
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(list(preload),)) as pool:
+        Handler.pool = pool
+        Handler.workers = workers
+        server = ThreadingHTTPServer((host, port), Handler)
+        print(f'serving on http://{host}:{port} with {workers} workers')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def request(settings, url='http://127.0.0.1:8765'):
+    # client: the answer of the service for the settings of a domain
+    data = json.dumps(settings).encode()
+    req = urllib.request.Request(f'{url}/regrid', data=data,
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req) as response:
+        return json.load(response)
+
+
+def read_settings(dfilename):
+    # settings of a domain file as a dict, for --preload
+    domain = Domain()
+    domain.read_domain_file(dfilename)
+    return {name: getattr(domain, name) for name in REQUIRED + [
+        'sg_tiles', 'reproject', 'sg_cache', 'sg_depths', 'sg_stats',
+        'sg_memmap', 'landuse', 'landuse_classes', 'interpolation']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--preload', nargs='*', default=[],
+                        help='domain files whose rasters are loaded at start')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers,
+          [read_settings(filename) for filename in args.preload])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
+import cProfile
+import sys
 import numpy as np
-import time
 
 # from helper import Helper
 from soilgrids import Soilgrids
 from domain import Domain
 from geo import Geo
+from metrics import metrics
+from cellcache import CellCache
+from checkpoint import Checkpoint
 from parallel import Parallel
+from partition import Partition
+from remap import Remap
 from output import Output
 
 
@@ -33,37 +39,115 @@ def plot_box(x_points, y_points, array, lon, lat):
 
 
 def main():
-    stime = time.time()
-    tot_time = time.time()
     domain = Domain()
-    soilgrids = Soilgrids()
-    parallel = Parallel()
     # geo = Geo(domain)
 
-    domain.read_domain_file()
-    domain.get_rlons_rlats()
+    # python soil_init.py my.domain [tile k | merge | tiles]
+    #                     [--interpolation box | nearest | bilinear]
+    args = sys.argv[2:]
+    options = []
+    if '--interpolation' in args:
+        k = args.index('--interpolation')
+        options = args[k:k+2]
+        del args[k:k+2]
+
+    with metrics.timer('domain'):
+        domain.read_domain_file()
+        if options:
+            # the command line overrides the domain file
+            domain.interpolation = options[-1]
+            domain.check_interpolation()
+            domain.check_landuse()
+        domain.get_rlons_rlats()
     print(domain.sg_res)
 
-    soilgrids.initialize(domain.sg_res)
-    print("init: ", time.time()-stime)
-    stime = time.time()
-
-    parallel.processing(domain, 10)
-    print("parallel processing: ", time.time()-stime)
-    stime = time.time()
-
-    interpolated_data = parallel.get_data()
-
-    output = Output(domain, interpolated_data)
-    output.write_netcdf()
-    print("output: ", time.time()-stime)
-    stime = time.time()
+    partition = Partition(domain)
+    command = args[0] if args else None
+    if command is None:
+        run(domain)
+    elif command == 'tile' and len(args) > 1:
+        run(partition.get_subdomain(int(args[1])))
+    elif command == 'merge':
+        partition.merge()
+    elif command == 'tiles':
+        # all tiles on this machine
+        partition.run_local(sys.argv[1], options=options)
+    else:
+        print('the command must be tile k, merge or tiles; exit')
+        exit()
+
+
+def run(domain):
+    parallel = Parallel()
+    max_processes = domain.processes
+
+    profile = None
+    if domain.cprofile is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+
+    with metrics.timer('init'):
+        soilgrids = Soilgrids.from_domain(domain)
+
+    if domain.reproject == 'direct':
+        with metrics.timer('reprojection'):
+            interpolated_data = soilgrids.reproject_to_domain(domain)
+
+        output = Output(domain, interpolated_data, domain.output)
+        output.write_netcdf()
+    elif domain.interpolation != 'box':
+        # quick look, the values at the centres of the grid boxes
+        with metrics.timer('interpolation'):
+            interpolated_data = soilgrids.sample(domain,
+                                                 domain.interpolation)
+
+        output = Output(domain, interpolated_data, domain.output)
+        output.write_netcdf()
+    elif domain.remap:
+        remap = Remap(domain, soilgrids)
+        with metrics.timer('remap weights'):
+            remap.initialize(parallel, max_processes)
+
+        with metrics.timer('averaging'):
+            interpolated_data = remap.interpolate()
+
+        output = Output(domain, interpolated_data, domain.output)
+        output.write_netcdf()
+    else:
+        # the row blocks are written to the output while processing
+        block_rows = 8
+        checkpoint = Checkpoint(domain) if domain.checkpoint else None
+        cache = CellCache(domain) if domain.cell_cache else None
+        output = Output(domain, filename=domain.output)
+        output.open(block_rows)
+        with metrics.timer('processing'):
+            parallel.processing(domain, max_processes, block_rows,
+                                output=output, checkpoint=checkpoint,
+                                backend=domain.backend, cache=cache,
+                                step=soilgrids.step)
+        output.close()
+        # the output is complete, the checkpoint is not needed anymore
+        if checkpoint is not None:
+            checkpoint.remove()
 
     # print(geo.get_corners(np.min(domain.rlons), np.min(domain.rlats)))
     # print(geo.get_corners(np.max(domain.rlons), np.max(domain.rlats)))
     # loop over all grid boxes
     # print(sand.shape)
-    print(time.time()-tot_time)
+    for name, seconds in metrics.timers.items():
+        print(f'{name}: {seconds:.3f} s')
+    print(f'total: {metrics.get_stats()["elapsed"]:.3f} s')
+
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(domain.cprofile)
+
+    if domain.report is not None:
+        metrics.write_report(domain.report, parallel.workers.values(),
+                             name=domain.name, sg_res=domain.sg_res,
+                             ie_tot=domain.ie_tot, je_tot=domain.je_tot,
+                             layers=len(domain.get_layers()),
+                             processes=max_processes)
 
 
 if __name__ == '__main__':
@@ -1,42 +1,398 @@
+import hashlib
+import os
 import numpy as np
 from geotiff import GeoTiff
 import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.transform import array_bounds
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+from concurrent.futures import ThreadPoolExecutor
 
 from helper import Helper
 from geo import Geo
+from memmap import Memmap
+from metrics import metrics
+from store import Store
+from tiles import Tiles
 
 
 class Soilgrids:
-    def __init__(self):
+    def __init__(self, store=None):
+        self.resolution = None
+        self.server = 'https://files.isric.org/soilgrids/latest/'
+        self.store = Store() if store is None else store
+
+        # (depth, statistic) of the layers, stacked along the first axis
+        self.layers = [('0-5cm', 'mean')]
+        # files converted to memory maps
+        self.memmap = False
+        # processing step of the files, the same for all of them
+        self.step = None
+
+        # one file and one GeoTiff per layer
         self.sandfile = None
         self.siltfile = None
         self.clayfile = None
         self.cfvofile = None
 
-    def initialize(self, resolution):
+        self.sandtiff = None
+        self.silttiff = None
+        self.claytiff = None
+        self.cfvotiff = None
+
+        # domain footprint read into memory by read_footprint, one array
+        # per layer as stored (int16, views of the memory maps), scaled
+        # and masked per grid box in read
+        self.footprint = None
+        self.sanddata = None
+        self.siltdata = None
+        self.claydata = None
+        self.cfvodata = None
+
+        # cover fraction of each land-use class on the pixel grid of the
+        # SoilGrids files, one raster per class over a part of the grid
+        # starting at the pixel landuseoffset (column, row); read with the
+        # same window as the SoilGrids files
+        self.landusefile = None
+        self.landusetiff = None
+        self.landusedata = None
+        self.landuseoffset = None
+
+    def initialize(self, resolution, tiledir='./soilgrids/fine',
+                   extent=None, convert=True, layers=None, memmap=False,
+                   landuse=None, step=None, classes=None, box=None):
+        # extent: (west, south, east, north), reproject only this part
+        # convert: False to use the raw (Homolosine) files
+        # layers: list of (depth, statistic), default 0-5cm mean
+        # memmap: read the EPSG:4326 files through memory maps
+        # landuse: land-use raster in any projection and resolution
+        # step: processing step chosen before, e.g. by the main process
+        # for its workers, default get_step
+        # classes: land-use classes with a cover fraction
+        # box: geographical box [(west, south), (east, north)] read later,
+        # the land use is only put on the pixel grid there
         self.check_resolution(resolution)
-
-        Helper().make_dir(f'./soilgrids/{resolution}')
-
-        for var in ['sand', 'silt', 'clay', 'cfvo']:
-            rawfilename = f'./soilgrids/{resolution}/{var}_{resolution}_raw.tif'
-            filename = f'./soilgrids/{resolution}/{var}_{resolution}.tif'
+        self.resolution = resolution
+        if layers is not None:
+            self.layers = layers
+        self.memmap = memmap
+
+        if resolution == 'fine':
+            self.initialize_tiles(tiledir)
+            if landuse is not None:
+                self.initialize_landuse(landuse, classes, box)
+            return
+
+        store = self.store
+        variables = ['sand', 'silt', 'clay', 'cfvo']
+        entries = []
+
+        if step is None:
+            step = self.get_step(resolution, extent, convert)
+        self.step = step
+        # the global products are converted without an extent
+        if step == 'epsg4326':
+            extent = None
+
+        for var in variables:
+            for depth, statistic in self.layers:
+                entries.append((var, depth, statistic, step))
+
+                rawfilename = store.get_path(var, resolution, 'raw', depth,
+                                             statistic)
+                filename = store.get_path(var, resolution, step, depth,
+                                          statistic)
+
+                # a raw file that does not match its download record is
+                # downloaded again before it is converted
+                if Helper().check_file(rawfilename) and \
+                        not Helper().check_file(filename) and \
+                        not Helper().check_download(rawfilename):
+                    print(f'{rawfilename} is damaged, downloading it again')
+                    os.remove(rawfilename)
+
+        # all missing raw files are downloaded at the same time
+        with metrics.timer('download'), \
+                ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(self.fetch_raw, var, resolution, k,
+                                       depth, statistic)
+                       for k, (var, depth, statistic, step)
+                       in enumerate(entries)
+                       if not Helper().check_file(store.get_path(
+                           var, resolution, step, depth, statistic)) and
+                       not Helper().check_file(store.get_path(
+                           var, resolution, 'raw', depth, statistic))]
+            for future in futures:
+                future.result()
+
+        self.sandfile, self.siltfile, self.clayfile, self.cfvofile = \
+            [], [], [], []
+        keep = []
+
+        for var, depth, statistic, step in entries:
+            rawfilename = store.get_path(var, resolution, 'raw', depth,
+                                         statistic)
+
+            with metrics.timer('reprojection'):
+                filename = store.fetch(
+                    lambda path: self.convert_to_epsg4326(rawfilename, path,
+                                                          extent),
+                    var, resolution, step, depth, statistic)
+            keep.append(filename)
+
+            if memmap:
+                # uncompressed copy of the same pixels, made once
+                tiffilename = filename
+                with metrics.timer('memmap'):
+                    filename = store.fetch(
+                        lambda path: Memmap.convert(tiffilename, path),
+                        var, resolution, step, depth, statistic, ext='npy')
+                keep.append(filename)
 
             if var == 'sand':
-                self.sandfile = filename
+                self.sandfile.append(filename)
             if var == 'silt':
-                self.siltfile = filename
+                self.siltfile.append(filename)
             if var == 'clay':
-                self.clayfile = filename
+                self.clayfile.append(filename)
             if var == 'cfvo':
-                self.cfvofile = filename
+                self.cfvofile.append(filename)
+
+        if landuse is not None:
+            keep += self.initialize_landuse(landuse, classes, box)
+
+        store.evict(keep=keep)
+
+    def get_step(self, resolution, extent=None, convert=True):
+        # the global products are used if all of them exist, otherwise the
+        # products for the extent are made and kept for the same extent;
+        # all files are read with the pixel window of one of them, so they
+        # have to be on the same grid
+        if not convert:
+            return 'raw'
+
+        step = 'epsg4326'
+        if extent is None or all(
+                Helper().check_file(self.store.get_path(
+                    var, resolution, step, depth, statistic))
+                for var in ['sand', 'silt', 'clay', 'cfvo']
+                for depth, statistic in self.layers):
+            return step
+
+        return step + '_' + '_'.join(f'{x:g}' for x in extent)
+
+    @staticmethod
+    def from_domain(domain, extent=None, step=None, box=None):
+        # Soilgrids initialized with the settings of the domain; extent
+        # and box: reprojected extent and footprint shared by several
+        # domains, default those of the domain; step: see initialize
+        if extent is None:
+            extent = domain.get_reproject_extent()
+        if box is None:
+            box = domain.get_box()
+
+        soilgrids = Soilgrids(Store(domain.sg_cache, domain.sg_cache_gb))
+        soilgrids.initialize(domain.sg_res, domain.sg_tiles, extent,
+                             convert=domain.reproject != 'direct',
+                             layers=domain.get_layers(),
+                             memmap=domain.sg_memmap,
+                             landuse=domain.landuse, step=step,
+                             classes=domain.get_classes(), box=box)
+
+        return soilgrids
+
+    def fetch_raw(self, var, resolution, position=0, depth='0-5cm',
+                  statistic='mean'):
+        print(f'Downloading {var} {depth} {statistic} from the soilgrids '
+              'file server')
+        url = self.make_url(var, resolution, depth, statistic)
+
+        return self.store.fetch(
+            lambda path: Helper().download_file(url, path, position=position),
+            var, resolution, 'raw', depth, statistic)
+
+    def initialize_tiles(self, tiledir):
+        # the 250m data is read from local EPSG:4326 tiles,
+        # {tiledir}/{layer}.vrt or a directory {tiledir}/{layer}/ of
+        # GeoTIFFs, the layer is {var} for 0-5cm mean and
+        # {var}_{depth}_{statistic} otherwise
+        self.sandfile, self.siltfile, self.clayfile, self.cfvofile = \
+            [], [], [], []
 
-            if not Helper().check_file(rawfilename) and not Helper().check_file(filename):
-                self.download_data(var, rawfilename, resolution)
+        for var in ['sand', 'silt', 'clay', 'cfvo']:
+            for depth, statistic in self.layers:
+                layer = var
+                if (depth, statistic) != ('0-5cm', 'mean'):
+                    layer = f'{var}_{depth}_{statistic}'
+
+                filename = f'{tiledir}/{layer}.vrt'
+                if not Helper().check_file(filename):
+                    filename = f'{tiledir}/{layer}'
+
+                if not Helper().check_file(filename) and \
+                        not os.path.isdir(filename):
+                    print(f'ERROR: SoilGrids tiles for {layer} not found in '
+                          f'"{tiledir}"')
+                    exit()
+
+                if var == 'sand':
+                    self.sandfile.append(filename)
+                if var == 'silt':
+                    self.siltfile.append(filename)
+                if var == 'clay':
+                    self.clayfile.append(filename)
+                if var == 'cfvo':
+                    self.cfvofile.append(filename)
+
+    def initialize_landuse(self, landuse, classes, box=None, margin=4):
+        # the cover fractions of the classes are put on the pixel grid of
+        # the sand files once, over the box plus margin pixels, and kept in
+        # the store; returns the files to keep
+        transform, width, height = self.get_grid()
+
+        col0, row0, col1, row1 = 0, 0, width, height
+        if box is not None:
+            (west, south), (east, north) = box
+            col0 = int(np.floor((west - transform.c) / transform.a)) - margin
+            col1 = int(np.ceil((east - transform.c) / transform.a)) + margin
+            row0 = int(np.floor((north - transform.f) / transform.e)) - margin
+            row1 = int(np.ceil((south - transform.f) / transform.e)) + margin
+        window = Window(col0, row0, col1 - col0, row1 - row0)
+        transform = window_transform(window, transform)
+        width, height = col1 - col0, row1 - row0
+
+        name = os.path.splitext(os.path.basename(landuse))[0]
+        grid = (os.path.abspath(landuse), tuple(transform)[:6], width, height,
+                list(classes))
+        step = f'{name}_{hashlib.sha256(repr(grid).encode()).hexdigest()[:8]}'
+
+        with metrics.timer('reprojection'):
+            filename = self.store.fetch(
+                lambda path: self.coregister(landuse, path, classes,
+                                             transform, width, height),
+                'landuse', self.resolution, step)
+        keep = [filename]
+        self.landusefile = [filename] * len(classes)
+
+        if self.memmap:
+            self.landusefile = []
+            for k, c in enumerate(classes):
+                with metrics.timer('memmap'):
+                    self.landusefile.append(self.store.fetch(
+                        lambda path: Memmap.convert(filename, path, k + 1),
+                        f'landuse_{c}', self.resolution, step, ext='npy'))
+            keep += self.landusefile
+
+        self.landuseoffset = (col0, row0)
+
+        return keep
+
+    def get_grid(self):
+        # EPSG:4326 transform, width and height of the sand files
+        filename = self.sandfile[0]
+        if self.resolution == 'fine' or self.memmap:
+            raster = Tiles(filename) if self.resolution == 'fine' \
+                else Memmap(filename)
+            return (from_origin(raster.left, raster.top, raster.dx, raster.dy),
+                    raster.width, raster.height)
+
+        with rasterio.open(filename) as src:
+            return src.transform, src.width, src.height
+
+    def coregister(self, input_file, output_file, classes, transform, width,
+                   height, max_pixels=2**22):
+        # cover fraction of each class in the pixels of the given EPSG:4326
+        # grid, one band per class: the average of the class indicator of
+        # the input pixels; input pixels without a class count as covered
+        # by none, pixels outside of the input are -1. The input is read in
+        # row blocks of the output of about max_pixels input pixels.
+        classes = np.array(classes)[:, None, None]
 
-            if not Helper().check_file(filename) and Helper().check_file(rawfilename):
-                self.convert_to_epsg4326(rawfilename, filename)
+        with rasterio.open(input_file) as src:
+            kwargs = dict(driver='GTiff', dtype='float32',
+                          count=len(classes), crs='EPSG:4326',
+                          transform=transform, width=width, height=height,
+                          nodata=-1, compress='deflate', tiled=True,
+                          blockxsize=256, blockysize=256)
+
+            # input pixels per output pixel
+            window = self.get_source_window(src, transform, width, height)
+            ratio = max(window.width * window.height / (width * height), 1)
+            rows = int(np.clip(max_pixels / (width * ratio), 1, height))
+
+            # the file is only in place once it is complete
+            tmpfile = f'{output_file}.tmp'
+            with rasterio.open(tmpfile, 'w', **kwargs) as dst:
+                for row0 in range(0, height, rows):
+                    block = Window(0, row0, width, min(rows, height - row0))
+                    block_transform = window_transform(block, transform)
+                    cover = np.full((len(classes), block.height, width), -1,
+                                    dtype=np.float32)
+
+                    window = self.get_source_window(
+                        src, block_transform, width, block.height)
+                    if window.width > 0 and window.height > 0:
+                        data = src.read(1, window=window)
+                        reproject(
+                            source=(data[None] == classes).astype(np.float32),
+                            destination=cover,
+                            src_transform=window_transform(window,
+                                                           src.transform),
+                            src_crs=src.crs,
+                            dst_transform=block_transform,
+                            dst_crs='EPSG:4326',
+                            dst_nodata=-1,
+                            resampling=Resampling.average,
+                            num_threads=os.cpu_count())
+
+                    dst.write(cover, window=block)
+
+        os.replace(tmpfile, output_file)
+
+    def get_source_window(self, src, transform, width, height):
+        # pixels of src covering an EPSG:4326 grid, plus one pixel around
+        # and cut to src
+        bounds = transform_bounds('EPSG:4326', src.crs,
+                                  *array_bounds(height, width, transform))
+        window = from_bounds(*bounds, transform=src.transform)
+        col0 = max(int(np.floor(window.col_off)) - 1, 0)
+        row0 = max(int(np.floor(window.row_off)) - 1, 0)
+        col1 = min(int(np.ceil(window.col_off + window.width)) + 1,
+                   src.width)
+        row1 = min(int(np.ceil(window.row_off + window.height)) + 1,
+                   src.height)
+
+        return Window(col0, row0, max(col1 - col0, 0), max(row1 - row0, 0))
+
+    def open(self):
+        if self.resolution == 'fine':
+            # only the index of the tiles is kept, tiles are read on demand
+            raster = Tiles
+        elif self.memmap:
+            # boxes are views of the memory maps, shared by all processes
+            raster = Memmap
+        else:
+            # keep the GeoTiff objects to avoid parsing the metadata for
+            # each read
+            raster = GeoTiff
+
+        self.sandtiff = [raster(filename) for filename in self.sandfile]
+        self.silttiff = [raster(filename) for filename in self.siltfile]
+        self.claytiff = [raster(filename) for filename in self.clayfile]
+        self.cfvotiff = [raster(filename) for filename in self.cfvofile]
+        if self.landusefile is not None and self.memmap:
+            self.landusetiff = [Memmap(filename)
+                                for filename in self.landusefile]
+        elif self.landusefile is not None:
+            # read by pixels of the sand grid, one band per class
+            self.landusetiff = [Tiles(filename, nodata=-1, band=k + 1)
+                                for k, filename in
+                                enumerate(self.landusefile)]
 
     def check_resolution(self, resolution):
         if resolution == 'coarse':
@@ -44,38 +400,34 @@ class Soilgrids:
         elif resolution == 'medium':
             pass
         elif resolution == 'fine':
-            print('sg_res = fine is not defined yet; exit')
-            exit()
+            pass
         else:
             print('sg_res must be coarse, medium or fine; exit')
             exit()
 
-    def make_url(self, var, resolution):
-        url = 'https://files.isric.org/soilgrids/latest/'
+    def make_url(self, var, resolution, depth='0-5cm', statistic='mean'):
+        url = self.server
+        layer = f'{var}_{depth}_{statistic}'
         if resolution == 'coarse':
-            url += f'data_aggregated/5000m/{var}/{var}_0-5cm_mean_5000.tif'
+            url += f'data_aggregated/5000m/{var}/{layer}_5000.tif'
         elif resolution == 'medium':
-            url += f'data_aggregated/1000m/{var}/{var}_0-5cm_mean_1000.tif'
+            url += f'data_aggregated/1000m/{var}/{layer}_1000.tif'
         elif resolution == 'fine':
-            print('sg_res = fine is not defined yet; exit')
+            print('sg_res = fine is read from local tiles, no download; exit')
             exit()
 
         return url
     # https://files.isric.org/soilgrids/latest/data_aggregated/5000m/clay/
 
-    def download_data(self, var, filename, resolution):
-        print(f'Downloading {var} from the soilgrids file server')
-
-        url = self.make_url(var, resolution)
-        Helper().download_file(url, filename)
-
-    def convert_to_epsg4326(self, input_file, output_file):
+    def convert_to_epsg4326(self, input_file, output_file, extent=None):
         """
         Convert a GeoTIFF file to EPSG:4326.
 
         Args:
             input_file (str): Path to the input GeoTIFF file.
             output_file (str): Path to save the output GeoTIFF file in EPSG:4326.
+            extent (tuple): Optional (west, south, east, north) in degrees,
+                only this part of the EPSG:4326 grid is reprojected.
         """
         print(input_file, output_file)
         # Open the input GeoTIFF file
@@ -87,6 +439,21 @@ class Soilgrids:
             transform, width, height = calculate_default_transform(
                 src.crs, dst_crs, src.width, src.height, *src.bounds)
 
+            if extent is not None:
+                # cut the extent out of the global grid, the pixels are
+                # the same as in the global product
+                window = from_bounds(*extent, transform=transform)
+                col0 = max(int(np.floor(window.col_off)), 0)
+                row0 = max(int(np.floor(window.row_off)), 0)
+                col1 = min(int(np.ceil(window.col_off + window.width)), width)
+                row1 = min(int(np.ceil(window.row_off + window.height)),
+                           height)
+
+                window = Window(col0, row0, col1 - col0, row1 - row0)
+                transform = window_transform(window, transform)
+                width = col1 - col0
+                height = row1 - row0
+
             # Set the output file options
             kwargs = src.meta.copy()
             kwargs.update({
@@ -96,8 +463,11 @@ class Soilgrids:
                 'height': height
             })
 
-            # Create the output GeoTIFF file and perform reprojection
-            with rasterio.open(output_file, 'w', **kwargs) as dst:
+            # Create the output GeoTIFF file and perform reprojection,
+            # only the source blocks needed for the output are read;
+            # the file is only in place once it is complete
+            tmpfile = f'{output_file}.tmp'
+            with rasterio.open(tmpfile, 'w', **kwargs) as dst:
                 for i in range(1, src.count + 1):
                     reproject(
                         source=rasterio.band(src, i),
@@ -106,28 +476,212 @@ class Soilgrids:
                         src_crs=src.crs,
                         dst_transform=transform,
                         dst_crs=dst_crs,
-                        resampling=Resampling.nearest)
-
-    def read(self, corner_x, corner_y):
+                        resampling=Resampling.nearest,
+                        num_threads=os.cpu_count(),
+                        warp_mem_limit=512)
+
+        os.replace(tmpfile, output_file)
+
+    def reproject_to_domain(self, domain):
+        # average the raw (Homolosine) data directly on the rotated model
+        # grid, without an EPSG:4326 intermediate
+        dst_crs = CRS.from_proj4(Geo(domain).get_proj4())
+
+        # rows from north to south, flipped to rlat order below
+        north = domain.startlat + (domain.je_tot - 0.5) * domain.dx
+        transform = from_origin(domain.startlon - domain.dx/2, north,
+                                domain.dx, domain.dx)
+
+        data = []
+        for files in [self.sandfile, self.siltfile,
+                      self.clayfile, self.cfvofile]:
+            field = np.full((len(files), domain.je_tot, domain.ie_tot),
+                            np.nan, dtype=np.float32)
+
+            for k, filename in enumerate(files):
+                with rasterio.open(filename) as src:
+                    nodata = src.nodata if src.nodata is not None else -32768
+                    reproject(
+                        source=rasterio.band(src, 1),
+                        destination=field[k],
+                        src_nodata=nodata,
+                        dst_transform=transform,
+                        dst_crs=dst_crs,
+                        dst_nodata=np.nan,
+                        resampling=Resampling.average,
+                        num_threads=os.cpu_count(),
+                        warp_mem_limit=512)
+
+            scales = self.get_scales().astype(np.float32)
+            field = field[:, ::-1, :] / scales[:, None, None]
+            data.append(np.where(field < 0, np.nan, field))
+
+        # all variables are masked with the sand mask, as in Parallel.get
+        sand, silt, clay, cfvo = data
+        silt[np.isnan(sand)] = np.nan
+        clay[np.isnan(sand)] = np.nan
+        cfvo[np.isnan(sand)] = np.nan
+
+        sand, silt, clay = self.norm_layers(sand, silt, clay)
+
+        return [sand, silt, clay, cfvo.astype(np.float32)]
+
+    def sample(self, domain, method='nearest', block_rows=64):
+        # quick-look fields: the rasters are sampled at the centres of the
+        # grid boxes instead of averaged over them, at the nearest pixel or
+        # bilinear between the four nearest pixel centres; all grid boxes
+        # of a row block at once
+        geo = Geo(domain)
+        data = np.full((4, len(self.layers), domain.je_tot, domain.ie_tot),
+                       np.nan, dtype=np.float32)
+
+        for j0 in range(0, domain.je_tot, block_rows):
+            j1 = min(j0 + block_rows, domain.je_tot)
+            self.read_footprint(domain, j0, j1)
+
+            lon, lat = geo.rot2geo(*np.meshgrid(domain.rlons,
+                                                domain.rlats[j0:j1]))
+            x, y = self.get_pixel(lon, lat)
+
+            # all variables are masked with the sand mask, as in
+            # Parallel.get
+            sandmask = np.ma.getmaskarray(self.get_values(self.sanddata))
+            for k, raw in enumerate([self.sanddata, self.siltdata,
+                                     self.claydata, self.cfvodata]):
+                field = self.get_values(raw)
+                valid = ~(sandmask | np.ma.getmaskarray(field))
+                values = np.ma.filled(field, 0.)
+                if method == 'bilinear':
+                    data[k, :, j0:j1, :] = self.bilinear(values, valid, x, y)
+                else:
+                    data[k, :, j0:j1, :] = self.nearest(values, valid, x, y)
+
+        sand, silt, clay, cfvo = data
+        sand, silt, clay = self.norm_layers(sand, silt, clay)
+
+        return [sand, silt, clay, cfvo]
+
+    def get_pixel(self, lon, lat):
+        # position in pixels from the corner of the footprint, the pixel
+        # (j, i) covers i <= x < i + 1 and j <= y < j + 1
+        geo_tiff = self.sandtiff[0]
+        (i0, j0), (i1, j1) = self.footprint
+        lon0, lat0 = geo_tiff.get_wgs_84_coords(i0, j0)
+        lon1, lat1 = geo_tiff.get_wgs_84_coords(i1, j1)
+
+        return ((lon - lon0) / (lon1 - lon0) * (i1 - i0),
+                (lat - lat0) / (lat1 - lat0) * (j1 - j0))
+
+    def nearest(self, values, valid, x, y):
+        # values (layers, height, width) of the pixels containing (x, y)
+        height, width = values.shape[1:]
+        ii = np.clip(np.floor(x).astype(int), 0, width - 1)
+        jj = np.clip(np.floor(y).astype(int), 0, height - 1)
+
+        return np.where(valid[:, jj, ii], values[:, jj, ii], np.nan)
+
+    def bilinear(self, values, valid, x, y):
+        # weighted by the distance to the four nearest pixel centres,
+        # pixels without data are left out and the weights of the others
+        # scaled up
+        height, width = values.shape[1:]
+        x = x - 0.5
+        y = y - 0.5
+        i0 = np.clip(np.floor(x).astype(int), 0, width - 2)
+        j0 = np.clip(np.floor(y).astype(int), 0, height - 2)
+        fx = np.clip(x - i0, 0., 1.)
+        fy = np.clip(y - j0, 0., 1.)
+
+        total = np.zeros((values.shape[0],) + x.shape)
+        weight = np.zeros_like(total)
+        for jj, ii, w in [(j0, i0, (1 - fx) * (1 - fy)),
+                          (j0, i0 + 1, fx * (1 - fy)),
+                          (j0 + 1, i0, (1 - fx) * fy),
+                          (j0 + 1, i0 + 1, fx * fy)]:
+            w = np.where(valid[:, jj, ii], w, 0.)
+            total += w * values[:, jj, ii]
+            weight += w
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight > 0, total / weight, np.nan)
+
+    def read_footprint(self, domain, j0=0, j1=None):
+        # read the bounding box of the domain (or of the rlat rows j0:j1)
+        # once per variable, the grid boxes are cut out of these arrays in read
+        self.read_area(domain.get_box(j0, j1))
+
+    def read_area(self, box):
+        # read a geographical box once per variable, e.g. the footprint
+        # of several domains together
+        if self.sandtiff is None:
+            self.open()
+
+        self.footprint = self.sandtiff[0].get_int_box(box, outer_points=2)
+
+        self.sanddata = self.read_box(self.sandtiff, box)
+        self.siltdata = self.read_box(self.silttiff, box)
+        self.claydata = self.read_box(self.claytiff, box)
+        self.cfvodata = self.read_box(self.cfvotiff, box)
+        self.landusedata = self.read_landuse(self.footprint)
+
+    def get_scales(self):
+        # SoilGrids stores g/kg and cm3/dm3, read as fractions;
+        # the uncertainty is kept as stored
+        return np.array([1. if statistic == 'uncertainty' else 1000.
+                         for depth, statistic in self.layers])
+
+    def read_box(self, geo_tiffs, box):
+        # the layers of a variable as stored, a list of views with memory
+        # maps; they are only stacked and copied by get_values
+        with metrics.timer('read'):
+            data = [geo_tiff.read_box(box, outer_points=2)
+                    for geo_tiff in geo_tiffs]
+        metrics.count('bytes_read', sum(layer.nbytes for layer in data))
+        return data
+
+    def get_values(self, data):
+        # fractions of the stored layers stacked along the first axis,
+        # masked where there is no data
+        data = np.stack(data)
+        return np.ma.masked_where(
+            data < 0, data / self.get_scales()[:, None, None])
+
+    def read_landuse(self, int_box):
+        # cover fractions (classes, height, width) of the pixels int_box of
+        # the sand grid, 0 outside of the land-use raster; None without
+        # land use
+        if self.landusetiff is None:
+            return None
+
+        col0, row0 = self.landuseoffset
+        int_box = tuple((i - col0, j - row0) for i, j in int_box)
+        with metrics.timer('read'):
+            data = np.stack([geo_tiff.read_int_box(int_box)
+                             for geo_tiff in self.landusetiff])
+        metrics.count('bytes_read', data.nbytes)
+        return np.maximum(data, 0)
+
+    def cut_footprint(self, data, int_box):
+        # views of the layers of the footprint, no data is copied
+        i0 = int_box[0][0] - self.footprint[0][0]
+        j0 = int_box[0][1] - self.footprint[0][1]
+        i1 = int_box[1][0] - self.footprint[0][0]
+        j1 = int_box[1][1] - self.footprint[0][1]
+
+        return [layer[j0:j1, i0:i1] for layer in data]
+
+    def get_window(self, corner_x, corner_y):
+        # pixel window and pixel edges around the corners of a grid box
         box = [(np.min(corner_x), np.min(corner_y)),
                (np.max(corner_x), np.max(corner_y))]
 
-        geo_tiff = GeoTiff(self.sandfile)
-        sand = geo_tiff.read_box(box, outer_points=2)
-        sand = np.ma.masked_where(sand < 0, sand/1000)
-        geo_tiff = GeoTiff(self.siltfile)
-        silt = geo_tiff.read_box(box, outer_points=2)
-        silt = np.ma.masked_where(silt < 0, silt/1000)
-        geo_tiff = GeoTiff(self.clayfile)
-        clay = geo_tiff.read_box(box, outer_points=2)
-        clay = np.ma.masked_where(clay < 0, clay/1000)
-        geo_tiff = GeoTiff(self.cfvofile)
-        cfvo = geo_tiff.read_box(box, outer_points=2)
-        cfvo = np.ma.masked_where(cfvo < 0, cfvo/1000)
+        if self.sandtiff is None:
+            self.open()
 
+        geo_tiff = self.cfvotiff[0]
         int_box = geo_tiff.get_int_box(box, outer_points=2)
 
-        dim = sand.shape
+        dim = (int_box[1][1] - int_box[0][1], int_box[1][0] - int_box[0][0])
 
         i = int_box[0][0]
         j = int_box[0][1]
@@ -138,35 +692,94 @@ class Soilgrids:
         lon = np.linspace(lon0, lon1, (dim[1])+1)
         lat = np.linspace(lat0, lat1, (dim[0]+1))
 
-        return sand, silt, clay, cfvo, lon, lat
-
-    def norm_box_mean(self, sand, silt, clay):
-
-        mean_sand = np.mean(sand)
-        mean_silt = np.mean(silt)
-        mean_clay = np.mean(clay)
-
-        total = mean_sand + mean_silt + mean_clay
-
-        count = 0
-        while total != 1:
-
-            count += 1
-            mean_sand = mean_sand / total
-            mean_silt = mean_silt / total
-            mean_clay = mean_clay / total
+        return box, int_box, lon, lat
 
-            total = mean_sand + mean_silt + mean_clay
-
-            if count >= 3:
-                delta = 1 - total
-                mean_clay = mean_clay - delta
-
-            if count > 5:
-                break
+    def read(self, corner_x, corner_y):
+        box, int_box, lon, lat = self.get_window(corner_x, corner_y)
+
+        if self.footprint is None:
+            sand = self.read_box(self.sandtiff, box)
+            silt = self.read_box(self.silttiff, box)
+            clay = self.read_box(self.claytiff, box)
+            cfvo = self.read_box(self.cfvotiff, box)
+            landuse = self.read_landuse(int_box)
+        else:
+            sand = self.cut_footprint(self.sanddata, int_box)
+            silt = self.cut_footprint(self.siltdata, int_box)
+            clay = self.cut_footprint(self.claydata, int_box)
+            cfvo = self.cut_footprint(self.cfvodata, int_box)
+            landuse = None
+            if self.landusedata is not None:
+                landuse = np.stack(self.cut_footprint(self.landusedata,
+                                                      int_box))
+
+        # only the window of the grid box is scaled
+        sand, silt, clay, cfvo = [self.get_values(data)
+                                  for data in [sand, silt, clay, cfvo]]
+
+        return sand, silt, clay, cfvo, lon, lat, landuse
+
+    def norm_mean(self, sand, silt, clay):
+        # normalize the mean fields of the whole domain so that
+        # sand + silt + clay = 1, grid boxes without data (ocean) are NaN
+        sand = np.array(sand, dtype=float)
+        silt = np.array(silt, dtype=float)
+        clay = np.array(clay, dtype=float)
+
+        valid = np.isfinite(sand) & np.isfinite(silt) & np.isfinite(clay)
+        sand[~valid] = np.nan
+        silt[~valid] = np.nan
+        clay[~valid] = np.nan
+
+        total = sand + silt + clay
+        active = valid & (total != 1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for count in range(1, 7):
+                sand = np.where(active, sand / total, sand)
+                silt = np.where(active, silt / total, silt)
+                clay = np.where(active, clay / total, clay)
+
+                total = np.where(active, sand + silt + clay, total)
+
+                if count >= 3:
+                    delta = 1 - total
+                    clay = np.where(active, clay - delta, clay)
+
+                active &= total != 1
+
+        return (sand.astype(np.float32), silt.astype(np.float32),
+                clay.astype(np.float32))
+
+    def norm_layers(self, sand, silt, clay):
+        # only the mean layers are normalized, the others are kept as read
+        sand = np.array(sand, dtype=float)
+        silt = np.array(silt, dtype=float)
+        clay = np.array(clay, dtype=float)
+
+        for k, (depth, statistic) in enumerate(self.layers):
+            if statistic == 'mean':
+                sand[k], silt[k], clay[k] = self.norm_mean(
+                    sand[k], silt[k], clay[k])
+
+        return (sand.astype(np.float32), silt.astype(np.float32),
+                clay.astype(np.float32))
+
+    def box_mean(self, var, weights=None):
+        # mean of each layer over the pixels of the grid box
+        var = var.reshape((var.shape[0], -1))
+        if weights is None:
+            mean_var = np.mean(var, axis=1)
+        else:
+            # weighted by the fraction of each pixel inside the grid box
+            mean_var = np.ma.average(var, axis=1, weights=weights.ravel())
+        return mean_var
 
-        return mean_sand, mean_silt, mean_clay
+    def class_fractions(self, landuse, weights):
+        # fraction of the grid box covered by each land-use class, from the
+        # cover fractions (classes, height, width) of its pixels
+        total = np.sum(weights)
+        if total <= 0:
+            return np.full(len(landuse), np.nan)
 
-    def box_mean(self, var):
-        mean_var = np.mean(var)
-        return mean_var
+        return np.sum(landuse * weights, axis=(1, 2)) / total
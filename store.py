@@ -0,0 +1,166 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from helper import Helper
+
+
+class Store:
+    """
+    Shared store of SoilGrids files, can be used by several jobs at once.
+
+    Each file is keyed by variable, depth, statistic, resolution and
+    processing step. A manifest in the root directory records the key,
+    the size and the last use of every file. Files are made under a lock
+    per entry and read under a shared lock on <entry>.use, held as long
+    as the Store object lives; the least recently used files that no job
+    makes or reads are removed when the store grows over budget_gb.
+    """
+
+    def __init__(self, root='./soilgrids', budget_gb=None):
+        self.root = root
+        self.budget = None if budget_gb is None else budget_gb * 1024**3
+
+        self.manifest = f'{root}/manifest.json'
+        # open lock files of the entries in use, by path
+        self.used = {}
+
+    def get_name(self, var, resolution, step, depth='0-5cm',
+                 statistic='mean', ext='tif'):
+        # the default depth and statistic keep the names of older versions
+        name = f'{var}_{resolution}'
+        if (depth, statistic) != ('0-5cm', 'mean'):
+            name = f'{var}_{depth}_{statistic}_{resolution}'
+        if step != 'epsg4326':
+            name += f'_{step}'
+
+        return f'{resolution}/{name}.{ext}'
+
+    def get_path(self, var, resolution, step, depth='0-5cm',
+                 statistic='mean', ext='tif'):
+        name = self.get_name(var, resolution, step, depth, statistic, ext)
+        return f'{self.root}/{name}'
+
+    @contextmanager
+    def lock(self, filename, blocking=True):
+        # exclusive lock between processes, yields False if not blocking
+        # and the lock is held by another process
+        with open(f'{filename}.lock', 'w') as lockfile:
+            flags = fcntl.LOCK_EX if blocking else \
+                fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lockfile, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def try_lock(self, file):
+        # exclusive lock without waiting, False if another job holds one
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def fetch(self, make, var, resolution, step, depth='0-5cm',
+              statistic='mean', ext='tif'):
+        # path of the entry, make(path) is called if it does not exist yet;
+        # make has to write the file atomically
+        name = self.get_name(var, resolution, step, depth, statistic, ext)
+        path = f'{self.root}/{name}'
+
+        Helper().make_dir(os.path.dirname(path))
+        self.use(path, make)
+
+        self.update(name, dict(var=var, depth=depth, statistic=statistic,
+                               resolution=resolution, step=step))
+
+        return path
+
+    def use(self, path, make):
+        # the file is made if it does not exist yet, then read under a
+        # shared lock until the Store is released, so that no other job
+        # evicts it
+        while path not in self.used:
+            if not Helper().check_file(path):
+                with self.lock(path):
+                    # another job may have made it while waiting
+                    if not Helper().check_file(path):
+                        make(path)
+
+            usefile = open(f'{path}.use', 'a')
+            fcntl.flock(usefile, fcntl.LOCK_SH)
+            # evicted after the check, made again
+            if not Helper().check_file(path):
+                usefile.close()
+                continue
+
+            self.used[path] = usefile
+
+    def update(self, name, key):
+        # record the use of an entry in the manifest
+        with self.lock(self.manifest):
+            entries = self.read_manifest()
+
+            path = f'{self.root}/{name}'
+            entry = entries.get(name, key)
+            entry['size'] = os.path.getsize(path) if \
+                Helper().check_file(path) else 0
+            entry['used'] = time.time()
+            entries[name] = entry
+
+            self.write_manifest(entries)
+
+    def read_manifest(self):
+        if not Helper().check_file(self.manifest):
+            return {}
+
+        with open(self.manifest) as file:
+            return json.load(file)
+
+    def write_manifest(self, entries):
+        tmpfile = f'{self.manifest}.tmp'
+        with open(tmpfile, 'w') as file:
+            json.dump(entries, file, indent=1)
+        os.replace(tmpfile, self.manifest)
+
+    def evict(self, keep=()):
+        # remove the least recently used entries until the store fits into
+        # the budget, except the paths in keep and entries being made or
+        # read by any job
+        if self.budget is None:
+            return
+
+        with self.lock(self.manifest):
+            entries = self.read_manifest()
+            total = sum(entry['size'] for entry in entries.values())
+
+            for name in sorted(entries, key=lambda n: entries[n]['used']):
+                if total <= self.budget:
+                    break
+                path = f'{self.root}/{name}'
+                if path in keep:
+                    continue
+
+                with self.lock(path, blocking=False) as locked, \
+                        open(f'{path}.use', 'a') as usefile:
+                    if not locked or not self.try_lock(usefile):
+                        continue
+
+                    # the lock files last, a job that opens them again
+                    # finds the entry missing
+                    print(f'Removing {path} from the SoilGrids store')
+                    for filename in [path, f'{path}.sha256', f'{path}.json',
+                                     f'{path}.use', f'{path}.lock']:
+                        if Helper().check_file(filename):
+                            os.remove(filename)
+
+                total -= entries.pop(name)['size']
+
+            self.write_manifest(entries)
@@ -0,0 +1,109 @@
+import glob
+import os
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+class Tiles:
+    """
+    Tiled EPSG:4326 raster (a directory of GeoTIFF tiles or a VRT) on one
+    common pixel grid, read through the same calls as geotiff.GeoTiff.
+
+    Only the tiles intersecting a requested box are opened and read, pixels
+    that are not covered by any tile are returned as nodata.
+    """
+
+    def __init__(self, path, nodata=-32768, band=1):
+        self.path = path
+        self.nodata = nodata
+        self.band = band
+
+        if os.path.isdir(path):
+            self.files = sorted(glob.glob(os.path.join(path, '**', '*.tif'),
+                                          recursive=True))
+        else:
+            self.files = [path]
+
+        if not self.files:
+            print(f'ERROR: no SoilGrids tiles found in "{path}"')
+            exit()
+
+        self.build_index()
+
+    def build_index(self):
+        # pixel extents of all tiles on the common grid
+        bounds = []
+        for filename in self.files:
+            with rasterio.open(filename) as src:
+                bounds.append(src.bounds)
+                self.dx, self.dy = src.res
+                self.dtype = src.dtypes[0]
+
+        bounds = np.array(bounds)
+
+        self.left = np.min(bounds[:, 0])
+        self.top = np.max(bounds[:, 3])
+
+        self.col0 = np.rint((bounds[:, 0] - self.left) / self.dx).astype(int)
+        self.row0 = np.rint((self.top - bounds[:, 3]) / self.dy).astype(int)
+        self.col1 = np.rint((bounds[:, 2] - self.left) / self.dx).astype(int)
+        self.row1 = np.rint((self.top - bounds[:, 1]) / self.dy).astype(int)
+
+        self.width = np.max(self.col1)
+        self.height = np.max(self.row1)
+
+        # all tiles have to be on the same grid
+        offset = (bounds[:, 0] - self.left) / self.dx - self.col0
+        if np.max(np.abs(offset)) > 1e-6:
+            print(f'ERROR: the tiles in "{self.path}" are not on one grid')
+            exit()
+
+    def get_wgs_84_coords(self, i, j):
+        return self.left + i * self.dx, self.top - j * self.dy
+
+    def get_int_box(self, box, outer_points=False):
+        # same index convention as GeoTiff.get_int_box
+        x_min = min(box[0][0], box[1][0])
+        x_max = max(box[0][0], box[1][0])
+        y_min = min(box[0][1], box[1][1])
+        y_max = max(box[0][1], box[1][1])
+
+        step_x = self.width / ((self.left + self.width * self.dx) - self.left)
+        step_y = self.height / (self.top - (self.top - self.height * self.dy))
+
+        i_min = int(step_x * (x_min - self.left)) + int(self.left != x_min)
+        j_min = int(step_y * (self.top - y_max)) + int(self.top != y_max)
+        i_max = int(step_x * (x_max - self.left))
+        j_max = int(step_y * (self.top - y_min))
+
+        n = int(outer_points)
+        return ((i_min - n, j_min - n), (i_max + n, j_max + n))
+
+    def read_box(self, box, outer_points=False):
+        return self.read_int_box(self.get_int_box(box, outer_points))
+
+    def read_int_box(self, int_box):
+        # pixels ((i_min, j_min), (i_max, j_max)) of the common grid
+        ((i_min, j_min), (i_max, j_max)) = int_box
+
+        data = np.full((j_max - j_min, i_max - i_min), self.nodata,
+                       dtype=self.dtype)
+
+        # tiles intersecting the box
+        hits = np.nonzero((self.col0 < i_max) & (self.col1 > i_min) &
+                          (self.row0 < j_max) & (self.row1 > j_min))[0]
+
+        for k in hits:
+            c0 = max(i_min, self.col0[k])
+            c1 = min(i_max, self.col1[k])
+            r0 = max(j_min, self.row0[k])
+            r1 = min(j_max, self.row1[k])
+
+            window = Window(c0 - self.col0[k], r0 - self.row0[k],
+                            c1 - c0, r1 - r0)
+            with rasterio.open(self.files[k]) as src:
+                data[r0 - j_min:r1 - j_min, c0 - i_min:c1 - i_min] = \
+                    src.read(self.band, window=window)
+
+        return data